@@ -0,0 +1,17 @@
+"""
+Benchmarks of matamazon.py.
+
+Every module is a script run from the repository root, e.g. python3 -m benchmarks.suite:
+    - workload:            generates system files and command logs in the format of the script.
+    - suite:               times loading, replay, searches, removals and exports at several scales,
+                           and compares the results with a saved baseline.
+    - bench_load:          load_system_from_file against the eval() based loader.
+    - bench_lazy:          startup time of lazy loading, with and without the saved offsets.
+    - bench_memory:        memory taken by the orders.
+    - bench_columns:       reprice and price filtered searches with the product columns.
+    - bench_replay:        replay_log throughput.
+    - bench_transactions:  carts of orders placed in committed and rolled back transactions.
+    - bench_async:         latency of AsyncMatamazonSystem under many clients.
+    - bench_sharded:       order throughput of ShardedMatamazonSystem.
+    - stress_concurrency:  ConcurrentMatamazonSystem under many threads.
+"""
@@ -0,0 +1,66 @@
+"""
+Simulate many concurrent asyncio clients placing orders through AsyncMatamazonSystem.
+
+Reports the order throughput and the p50/p99 latency of a request, from the call of place_order
+until its status message is returned.
+
+Usage:
+    python3 -m benchmarks.bench_async [-c <clients>] [-n <orders per client>] [-b <batch size>]
+"""
+import argparse
+import asyncio
+import io
+import random
+import time
+
+from matamazon import Customer, Supplier, Product, MatamazonSystem, AsyncMatamazonSystem, _percentile
+
+
+def make_system(products):
+    system = MatamazonSystem()
+    system.register_entity(Supplier(0, "Supplier", "Haifa", "Herzl"), False)
+    for i in range(1, 101):
+        system.register_entity(Customer(i, f"Customer {i}", "Haifa", "Main Street"), True)
+    system.upsert_products(Product(i, f"product {i}", 10.0, 0, 10 ** 9) for i in range(products))
+    return system
+
+
+async def client(shop, index, orders, products, latencies):
+    rnd = random.Random(index)
+    for _ in range(orders):
+        start = time.perf_counter()
+        await shop.place_order(rnd.randint(1, 100), rnd.randrange(products), rnd.randint(1, 3))
+        latencies.append(time.perf_counter() - start)
+
+        if rnd.random() < 0.01:
+            await shop.search_products(f"product {rnd.randrange(products)}")
+
+
+async def simulate(clients, orders, products, batch_size):
+    latencies = []
+    async with AsyncMatamazonSystem(make_system(products), batch_size) as shop:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(shop, index, orders, products, latencies) for index in range(clients)),
+                             shop.export_orders(io.StringIO()))
+        elapsed = time.perf_counter() - start
+    return elapsed, sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-c", type=int, default=1000, help="number of concurrent clients")
+    parser.add_argument("-n", type=int, default=100, help="orders placed by every client")
+    parser.add_argument("-p", type=int, default=10_000, help="number of products")
+    parser.add_argument("-b", type=int, default=None, help="largest micro-batch of orders")
+    args = parser.parse_args()
+
+    elapsed, latencies = asyncio.run(simulate(args.c, args.n, args.p, args.b))
+    print(f"clients:    {args.c}")
+    print(f"orders:     {len(latencies)}")
+    print(f"throughput: {len(latencies) / elapsed:,.0f} orders/s")
+    print(f"p50:        {_percentile(latencies, 50) * 1000:.2f} ms")
+    print(f"p99:        {_percentile(latencies, 99) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
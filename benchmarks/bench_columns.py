@@ -0,0 +1,61 @@
+"""
+Measure the product columns (MatamazonSystem(product_columns=True)).
+
+Compares repricing all the products of a supplier by reprice with updating them one by one by
+add_or_update_product, and price filtered searches that the name index can't narrow down with and
+without the columns.
+
+Usage:
+    python3 -m benchmarks.bench_columns [-p <products>] [-s <suppliers>] [-q <searches>]
+"""
+import argparse
+import random
+
+import matamazon
+from matamazon import Supplier, Product, MatamazonSystem
+from benchmarks.suite import timed
+
+
+def make_system(products, suppliers, product_columns):
+    rnd = random.Random(0)
+    system = MatamazonSystem(search_cache_size=0, product_columns=product_columns)
+    system.register_many((Supplier(i, f"Supplier {i}", "Haifa", "Herzl"), False) for i in range(suppliers))
+    system.upsert_products(Product(i, f"product {i}", rnd.randint(1, 1000) + 0.99, i % suppliers,
+                                   rnd.choice([0, 0, 5, 10])) for i in range(products))
+    return system
+
+
+def update_one_by_one(system, supplier_id, factor):
+    for product in [product for product in system.products.values() if product.supplier_id == supplier_id]:
+        system.add_or_update_product(Product(product.id, product.name, product.price * factor, supplier_id,
+                                             product.quantity))
+
+
+def searches(system, count):
+    rnd = random.Random(1)
+    for _ in range(count):
+        system.search_products("", rnd.randint(1, 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-p", type=int, default=200_000, help="number of products")
+    parser.add_argument("-s", type=int, default=10, help="number of suppliers")
+    parser.add_argument("-q", type=int, default=200, help="number of searches")
+    args = parser.parse_args()
+
+    plain = make_system(args.p, args.s, False)
+    columns = make_system(args.p, args.s, True)
+    backend = "NumPy" if matamazon.ProductColumns().vectorized else "Python fallback"
+
+    print(f"products: {args.p}, products of a supplier: {args.p // args.s}, columns: {backend}")
+    print(f"update one by one:       {timed(update_one_by_one, plain, 0, 1.1)[0]:8.3f}s")
+    print(f"reprice without columns: {timed(plain.reprice, 1, 1.1)[0]:8.3f}s")
+    print(f"reprice with columns:    {timed(columns.reprice, 1, 1.1)[0]:8.3f}s")
+    print(f"restock with columns:    {timed(columns.restock, 2, 5)[0]:8.3f}s")
+    print(f"{args.q} searches without columns: {timed(searches, plain, args.q)[0]:8.3f}s")
+    print(f"{args.q} searches with columns:    {timed(searches, columns, args.q)[0]:8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
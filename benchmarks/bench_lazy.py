@@ -0,0 +1,48 @@
+"""
+Compare the startup time of load_system_from_file with lazy loading (load_system_lazily).
+
+Times loading a generated system file eagerly, lazily when the file is scanned for the first time,
+and lazily again when the offsets saved by the first lazy load are read, and then replaying a short
+log of orders on the lazily loaded system.
+
+Usage:
+    python3 -m benchmarks.bench_lazy [-p <products>] [-n <orders>]
+"""
+import argparse
+import os
+import random
+import tempfile
+
+import matamazon
+from benchmarks import workload
+from benchmarks.suite import timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-p", type=int, default=200_000, help="number of products")
+    parser.add_argument("-n", type=int, default=100, help="number of orders in the short log")
+    args = parser.parse_args()
+
+    customers, suppliers = args.p // 10, max(1, args.p // 100)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "system.txt")
+        workload.write_system_file(path, customers, suppliers, args.p)
+
+        eager, _ = timed(matamazon.load_system_from_file, path)
+        scan, _ = timed(matamazon.load_system_from_file, path, True)
+        indexed, system = timed(matamazon.load_system_from_file, path, True)
+
+        rnd = random.Random(0)
+        orders = [(rnd.randrange(customers), rnd.randrange(args.p), 1) for _ in range(args.n)]
+        replay, _ = timed(system.place_orders, orders)
+
+    print(f"objects: {customers + suppliers + args.p}")
+    print(f"eager load:                {eager:8.3f}s")
+    print(f"lazy load, scanning:       {scan:8.3f}s")
+    print(f"lazy load, saved offsets:  {indexed:8.3f}s")
+    print(f"{args.n} orders after a lazy load: {replay:8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
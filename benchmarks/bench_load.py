@@ -0,0 +1,77 @@
+"""
+Compare load_system_from_file with the eval() based loader it replaced.
+
+Usage:
+    python3 -m benchmarks.bench_load [-n <objects>] [-r <repeats>]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import matamazon
+from matamazon import Customer, Supplier, Product, Order, MatamazonSystem
+
+
+def eval_load_system_from_file(path):
+    """The previous load_system_from_file, which evaluated every line."""
+    system = MatamazonSystem()
+    products = {}
+    with open(path, 'r') as file:
+        for line in file:
+            line = line.strip()
+            try:
+                val = eval(line, {"Customer": Customer, "Supplier": Supplier, "Product": Product, "Order": Order})
+                if isinstance(val, Customer):
+                    system.customers[val.id] = val
+                elif isinstance(val, Supplier):
+                    system.suppliers[val.id] = val
+                elif isinstance(val, Product):
+                    products[val.id] = val
+            except (NameError, SyntaxError, TypeError):
+                continue
+    system._store_products(products.values())
+    return system
+
+
+def write_system_file(path, count):
+    with open(path, 'w') as file:
+        for i in range(count // 10):
+            file.write(f"{Customer(i, f'Customer {i}', 'Haifa', f'{i} Main Street, apt 2')}\n")
+        for i in range(count // 10):
+            file.write(f"{Supplier(count + i, f'Supplier {i}', 'Tel Aviv', f'{i} Herzl Street')}\n")
+        for i in range(count - 2 * (count // 10)):
+            file.write(f"{Product(i, f'Product number {i}', i % 1000 + 0.99, count + i % (count // 10), 10)}\n")
+
+
+def best_time(function, path, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=200_000, help="number of objects in the system file")
+    parser.add_argument("-r", type=int, default=3, help="number of repeats (the best time is reported)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "system.txt")
+        write_system_file(path, args.n)
+
+        eval_time = best_time(eval_load_system_from_file, path, args.r)
+        parser_time = best_time(matamazon.load_system_from_file, path, args.r)
+
+    print(f"objects:                {args.n}")
+    print(f"eval loader:            {eval_time:.3f}s ({args.n / eval_time:,.0f} lines/s)")
+    print(f"load_system_from_file:  {parser_time:.3f}s ({args.n / parser_time:,.0f} lines/s)")
+    print(f"speedup:                {eval_time / parser_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Measure the memory taken by the orders of a MatamazonSystem.
+
+Compares orders stored as regular objects with a __dict__ (the classes before __slots__ were added),
+__slots__ Order objects and the column based OrderTable.
+
+Usage:
+    python3 -m benchmarks.bench_memory [-n <orders>]
+"""
+import argparse
+import gc
+import tracemalloc
+
+from matamazon import Order, OrderTable
+
+
+class DictOrder:
+    """Order as it was before __slots__: every instance has its own __dict__."""
+
+    def __init__(self, id, customer_id, product_id, quantity, total_price):
+        self.id = id
+        self.customer_id = customer_id
+        self.product_id = product_id
+        self.quantity = quantity
+        self.total_price = total_price
+
+
+def measure(orders, order_class, count):
+    gc.collect()
+    tracemalloc.start()
+    for id in range(1, count + 1):
+        orders[id] = order_class(id, id % 10_000, id % 50_000, 1 + id % 5, (1 + id % 5) * 9.99)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=1_000_000, help="number of orders")
+    args = parser.parse_args()
+
+    results = [
+        ("dict of __dict__ orders", measure({}, DictOrder, args.n)),
+        ("dict of __slots__ orders", measure({}, Order, args.n)),
+        ("OrderTable", measure(OrderTable(), Order, args.n)),
+    ]
+
+    baseline = results[0][1]
+    print(f"orders: {args.n}")
+    for name, size in results:
+        print(f"{name:26} {size / 2 ** 20:9.1f} MiB  {size / args.n:6.1f} B/order  {baseline / size:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Measure the log replay throughput of replay_log in lines per second.
+
+Usage:
+    python3 -m benchmarks.bench_replay [-n <lines>] [-p <products>]
+"""
+import argparse
+import io
+import random
+import time
+
+from matamazon import Customer, Supplier, Product, MatamazonSystem, replay_log
+
+
+def make_system(products, seed=0):
+    rnd = random.Random(seed)
+    system = MatamazonSystem()
+    for i in range(products // 10):
+        system.register_entity(Customer(i, f"Customer {i}", "Haifa", "Main Street"), True)
+    suppliers = max(1, products // 100)
+    for i in range(suppliers):
+        system.register_entity(Supplier(products + i, f"Supplier {i}", rnd.choice(["Haifa", "Eilat"]), "Herzl"), False)
+    system.upsert_products(Product(i, f"product {i}", rnd.randint(1, 1000) + 0.99, products + i % suppliers, 1_000_000)
+                           for i in range(products))
+    return system
+
+
+def make_log(lines, products, seed=0):
+    rnd = random.Random(seed)
+    customers = products // 10
+    suppliers = max(1, products // 100)
+    log = []
+    for _ in range(lines):
+        r = rnd.random()
+        if r < 0.6:
+            log.append(f"order {rnd.randrange(customers)} {rnd.randrange(products)} {rnd.randint(1, 3)}\n")
+        elif r < 0.8:
+            product_id = rnd.randrange(products)
+            log.append(f"update {product_id} product_{rnd.randrange(products)} {rnd.randint(1, 1000)}.5 "
+                       f"{products + product_id % suppliers} 1000000\n")
+        elif r < 0.9:
+            log.append(f"remove order {rnd.randint(1, 1000)}\n")
+        else:
+            log.append(f"search product_{rnd.randrange(products)} {rnd.randint(1, 1000)}\n")
+    return log
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=500_000, help="number of log lines")
+    parser.add_argument("-p", type=int, default=20_000, help="number of products in the system")
+    args = parser.parse_args()
+
+    system = make_system(args.p)
+    log = make_log(args.n, args.p)
+
+    start = time.perf_counter()
+    replay_log(system, log, io.StringIO())
+    elapsed = time.perf_counter() - start
+
+    print(f"lines:      {args.n}")
+    print(f"time:       {elapsed:.3f}s")
+    print(f"throughput: {args.n / elapsed:,.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
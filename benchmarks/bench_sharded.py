@@ -0,0 +1,56 @@
+"""
+Compare the order throughput of MatamazonSystem with ShardedMatamazonSystem.
+
+Orders are placed in batches by place_orders, which the shards run in parallel.
+
+Usage:
+    python3 -m benchmarks.bench_sharded [-s 1 2 4] [-n <orders>] [-b <batch size>] [-p <products>]
+"""
+import argparse
+import random
+import time
+
+from matamazon import Supplier, Product, MatamazonSystem, ShardedMatamazonSystem
+
+
+def fill(system, products, suppliers):
+    system.register_many((Supplier(products + i, f"Supplier {i}", "Haifa", "Herzl"), False)
+                         for i in range(suppliers))
+    system.upsert_products(Product(i, f"product {i}", i % 100 + 0.99, products + i % suppliers, 10 ** 9)
+                           for i in range(products))
+
+
+def run(system, orders, batch_size):
+    start = time.perf_counter()
+    for position in range(0, len(orders), batch_size):
+        system.place_orders(orders[position:position + batch_size])
+    return len(orders) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-s", type=int, nargs="+", default=[1, 2, 4], help="shard counts")
+    parser.add_argument("-n", type=int, default=500_000, help="number of orders")
+    parser.add_argument("-b", type=int, default=10_000, help="orders placed by every place_orders")
+    parser.add_argument("-p", type=int, default=100_000, help="number of products")
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    orders = [(rnd.randrange(10_000), rnd.randrange(args.p), rnd.randint(1, 3)) for _ in range(args.n)]
+    suppliers = max(1, args.p // 100)
+
+    system = MatamazonSystem()
+    fill(system, args.p, suppliers)
+    baseline = run(system, orders, args.b)
+    print(f"{'system':>18} {'orders/s':>12}")
+    print(f"{'MatamazonSystem':>18} {baseline:>12,.0f}")
+
+    for shards in args.s:
+        with ShardedMatamazonSystem(shards) as sharded:
+            fill(sharded, args.p, suppliers)
+            throughput = run(sharded, orders, args.b)
+        print(f"{f'{shards} shards':>18} {throughput:>12,.0f}  {throughput / baseline:4.1f}x")
+
+
+if __name__ == "__main__":
+    main()
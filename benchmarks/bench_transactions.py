@@ -0,0 +1,69 @@
+"""
+Measure the cost of MatamazonSystem.transaction.
+
+Times carts of orders placed without a transaction, in committed transactions and in rolled back
+transactions, and compares them with copying the system (copy.deepcopy) to be able to restore it.
+
+Usage:
+    python3 -m benchmarks.bench_transactions [-p <products>] [-c <carts>] [-i <items per cart>]
+"""
+import argparse
+import copy
+import random
+import time
+
+from matamazon import Customer, Supplier, Product, MatamazonSystem
+
+
+class Cancelled(Exception):
+    pass
+
+
+def make_system(products):
+    system = MatamazonSystem()
+    system.register_many([(Customer(0, "Customer", "Haifa", "Herzl"), True),
+                          (Supplier(1, "Supplier", "Haifa", "Herzl"), False)])
+    system.upsert_products(Product(i, f"product {i}", i % 100 + 0.99, 1, 10 ** 9) for i in range(products))
+    return system
+
+
+def place_carts(system, carts, transaction, cancel):
+    start = time.perf_counter()
+    for cart in carts:
+        if not transaction:
+            system.place_orders(cart)
+            continue
+
+        try:
+            with system.transaction():
+                system.place_orders(cart)
+                if cancel:
+                    raise Cancelled()
+        except Cancelled:
+            pass
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-p", type=int, default=100_000, help="number of products")
+    parser.add_argument("-c", type=int, default=10_000, help="number of carts")
+    parser.add_argument("-i", type=int, default=5, help="orders in a cart")
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    carts = [[(0, rnd.randrange(args.p), 1) for _ in range(args.i)] for _ in range(args.c)]
+
+    print(f"{args.c} carts of {args.i} orders, {args.p} products")
+    print(f"without transactions:     {place_carts(make_system(args.p), carts, False, False):8.3f}s")
+    print(f"committed transactions:   {place_carts(make_system(args.p), carts, True, False):8.3f}s")
+    print(f"rolled back transactions: {place_carts(make_system(args.p), carts, True, True):8.3f}s")
+
+    system = make_system(args.p)
+    start = time.perf_counter()
+    copy.deepcopy(system)
+    print(f"one copy of the system:   {time.perf_counter() - start:8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
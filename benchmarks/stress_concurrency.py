@@ -0,0 +1,83 @@
+"""
+Stress test of ConcurrentMatamazonSystem: many threads order the same few products at once.
+
+Checks that no product is oversold, that every accepted order got a unique ID, and that the
+stock left plus the ordered quantities add up to the initial stock. Reports the order throughput
+for every thread count.
+
+Usage:
+    python3 -m benchmarks.stress_concurrency [-t 1 2 4 8] [-n <orders per thread>] [-p <products>]
+"""
+import argparse
+import random
+import threading
+import time
+
+from matamazon import Customer, Supplier, Product, ConcurrentMatamazonSystem
+
+accepted = "The order has been accepted in the system"
+
+
+def make_system(products, stock):
+    system = ConcurrentMatamazonSystem()
+    system.register_entity(Supplier(0, "Supplier", "Haifa", "Herzl"), False)
+    system.register_entity(Customer(1, "Customer", "Haifa", "Main Street"), True)
+    for i in range(products):
+        system.add_or_update_product(Product(i, f"product {i}", 10.0, 0, stock))
+    return system
+
+
+def run(threads, orders_per_thread, products, stock):
+    system = make_system(products, stock)
+    ordered = [[0] * products for _ in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(index):
+        rnd = random.Random(index)
+        counts = ordered[index]
+        barrier.wait()
+        for _ in range(orders_per_thread):
+            product_id = rnd.randrange(products)
+            quantity = rnd.randint(1, 3)
+            if system.place_order(1, product_id, quantity) == accepted:
+                counts[product_id] += quantity
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    for product_id in range(products):
+        product = system.products[product_id]
+        total = sum(counts[product_id] for counts in ordered)
+        assert product.quantity >= 0, f"product {product_id} was oversold"
+        assert product.quantity + total == stock, f"stock of product {product_id} doesn't add up"
+
+    order_ids = list(system.orders)
+    assert len(set(order_ids)) == len(order_ids) == system.next_id - 1, "order IDs are not unique"
+    assert sorted(order_ids) == list(range(1, system.next_id)), "order IDs are not consecutive"
+
+    return threads * orders_per_thread / elapsed, len(order_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-t", type=int, nargs="+", default=[1, 2, 4, 8], help="thread counts")
+    parser.add_argument("-n", type=int, default=50_000, help="orders placed by every thread")
+    parser.add_argument("-p", type=int, default=16, help="number of products")
+    parser.add_argument("-s", type=int, default=20_000, help="initial stock of every product")
+    args = parser.parse_args()
+
+    print(f"{'threads':>7} {'orders/s':>12} {'accepted':>9}")
+    for threads in args.t:
+        throughput, accepted_orders = run(threads, args.n, args.p, args.s)
+        print(f"{threads:>7} {throughput:>12,.0f} {accepted_orders:>9}")
+    print("no oversold products, order IDs unique")
+
+
+if __name__ == "__main__":
+    main()
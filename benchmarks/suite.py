@@ -0,0 +1,184 @@
+"""
+Time the main operations of matamazon.py on synthetic workloads of several sizes.
+
+For every scale, a system file and a log are generated by benchmarks.workload (products = scale,
+customers = scale / 10, suppliers = scale / 100, orders in the log = scale), and the suite times:
+    - load:            load_system_from_file of the system file.
+    - replay:          replay_log of the log on the loaded system.
+    - search:          search_products of generated queries.
+    - remove:          remove_object of a sample of the orders.
+    - export_orders:   export_orders (JSON) and export_orders_ndjson.
+    - export_system:   export_system_to_file.
+
+The results are written as JSON. Given a baseline (the JSON of a previous run), every timing is
+compared with it, and the suite exits with status 1 if one of them is slower by more than the
+threshold.
+
+Usage:
+    python3 -m benchmarks.suite [--scales 10k 100k 1m 10m] [-r <repeats>] [-o results.json]
+                                [--baseline baseline.json] [--threshold 0.2]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import matamazon
+from benchmarks import workload
+
+scales = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000, "10m": 10_000_000}
+
+# number of searches and removals timed at every scale
+searches = 2_000
+removals = 10_000
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def run_scale(size, directory, seed=0):
+    """
+    Time every operation once on a workload of the given size.
+
+    Returns:
+        dict: dictionary(operation,(seconds, number of items the operation handled))
+    """
+    system_path, log_path = workload.write_workload(directory, size // 10, max(1, size // 100), size, size,
+                                                    seed=seed)
+    with open(log_path) as file:
+        log_lines = sum(1 for _ in file)
+
+    timings = {}
+    seconds, system = timed(matamazon.load_system_from_file, system_path)
+    timings["load"] = (seconds, len(system.customers) + len(system.suppliers) + len(system.products))
+
+    with open(os.devnull, 'w') as out:
+        seconds, _ = timed(matamazon.replay_log, system, matamazon.read_lines(log_path), out)
+    timings["replay"] = (seconds, log_lines)
+
+    rnd = random.Random(seed)
+    queries = [(workload.search_query(rnd), rnd.choice([None, 20, 50])) for _ in range(searches)]
+    search_products = system.search_products
+    start = time.perf_counter()
+    for query, max_price in queries:
+        search_products(query, max_price)
+    timings["search"] = (time.perf_counter() - start, len(queries))
+
+    output_path = os.path.join(directory, "orders.json")
+    with open(output_path, 'w') as file:
+        seconds, _ = timed(system.export_orders, file)
+    timings["export_orders"] = (seconds, len(system.orders))
+
+    with open(output_path, 'w') as file:
+        seconds, _ = timed(system.export_orders_ndjson, file)
+    timings["export_orders_ndjson"] = (seconds, len(system.orders))
+
+    seconds, _ = timed(system.export_system_to_file, os.path.join(directory, "out_system.txt"))
+    timings["export_system"] = (seconds, len(system.customers) + len(system.suppliers) + len(system.products))
+
+    order_ids = rnd.sample(list(system.orders), min(removals, len(system.orders)))
+    remove_object = system.remove_object
+    start = time.perf_counter()
+    for order_id in order_ids:
+        remove_object(order_id, "Order")
+    timings["remove"] = (time.perf_counter() - start, len(order_ids))
+
+    return timings
+
+
+def run(scale_names, repeats):
+    """
+    Run the suite, keeping the best time of every operation over the repeats.
+
+    Returns:
+        dict: The results, as written to the JSON file.
+    """
+    results = {}
+    for name in scale_names:
+        best = {}
+        for repeat in range(repeats):
+            with tempfile.TemporaryDirectory() as directory:
+                for operation, (seconds, count) in run_scale(scales[name], directory).items():
+                    if operation not in best or seconds < best[operation][0]:
+                        best[operation] = (seconds, count)
+
+        results[name] = {operation: {"seconds": seconds, "count": count,
+                                     "per_second": count / seconds if seconds else None}
+                         for operation, (seconds, count) in best.items()}
+        print_scale(name, results[name])
+
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "repeats": repeats,
+        "results": results,
+    }
+
+
+def print_scale(name, operations):
+    print(f"{name}:")
+    for operation, result in operations.items():
+        rate = f"{result['per_second']:>14,.0f}/s" if result["per_second"] else ""
+        print(f"  {operation:22} {result['seconds']:9.3f}s {result['count']:>11,} {rate}")
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare the timings with a baseline run.
+
+    Returns:
+        list[str]: "<scale> <operation>" of every operation slower than the baseline by more than
+            threshold (a fraction of the baseline time).
+    """
+    regressions = []
+    print(f"compared with the baseline (slower by more than {threshold:.0%} is a regression):")
+    for name, operations in results["results"].items():
+        base_operations = baseline.get("results", {}).get(name, {})
+        for operation, result in operations.items():
+            base = base_operations.get(operation)
+            if base is None or not base["seconds"]:
+                continue
+
+            ratio = result["seconds"] / base["seconds"]
+            regressed = ratio > 1 + threshold
+            if regressed:
+                regressions.append(f"{name} {operation}")
+            print(f"  {name:5} {operation:22} {base['seconds']:9.3f}s -> {result['seconds']:9.3f}s "
+                  f"{ratio:6.2f}x{'  REGRESSION' if regressed else ''}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", nargs="+", choices=scales, default=["10k", "100k"], help="workload sizes")
+    parser.add_argument("-r", type=int, default=1, help="number of repeats (the best time is kept)")
+    parser.add_argument("-o", default=None, help="JSON file the results are written to")
+    parser.add_argument("--baseline", default=None, help="JSON results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown, as a fraction of the baseline time, reported as a regression")
+    args = parser.parse_args()
+
+    results = run(args.scales, args.r)
+    if args.o:
+        with open(args.o, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Generate synthetic Matamazon system files and command logs, in the formats the script reads.
+
+IDs are laid out so that every generated command is valid: customers are 0..customers-1, suppliers
+follow them, products are numbered from 0 and product i belongs to supplier i % suppliers (updates
+keep it), and customers registered by the log get new IDs. Replaying a log on its system file never
+raises, so the whole log is applied.
+
+Usage:
+    python3 -m benchmarks.workload -d <directory> [-c <customers>] [-s <suppliers>] [-p <products>]
+                                   [-n <orders>] [--mix order=60 search=20 ...] [--seed <seed>]
+"""
+import argparse
+import itertools
+import os
+import random
+
+from matamazon import Customer, Supplier, Product
+
+adjectives = ["Red", "Green", "Blue", "Organic", "Fresh", "Smart", "Wireless", "Classic", "Mini", "Deluxe",
+              "Portable", "Vintage", "Soft", "Large", "Electric", "Wooden"]
+nouns = ["Apple", "Banana", "Headphones", "Cushion", "Lamp", "Keyboard", "Mug", "Backpack", "Charger", "Blender",
+         "Notebook", "Sneakers", "Pillow", "Speaker", "Kettle", "Jacket"]
+# brands of the products: made up words of three syllables
+brands = [f"{a}{b}{c}".capitalize() for a, b, c in itertools.product(
+    ["ka", "lo", "mi", "zen", "tro", "vi", "ra", "no"], ["sa", "pe", "du", "xo", "li", "mar", "to", "gu"],
+    ["n", "ra", "x", "lo", "tek", "ia", "on", "ma"])]
+cities = ["Haifa", "Tel Aviv", "Jerusalem", "Eilat", "Beer Sheva", "Nazareth", "Ashdod", "Netanya"]
+
+# share of every command in the generated log (the weights are relative to each other)
+default_mix = {
+    "order": 60,
+    "search": 20,
+    "update": 8,
+    "add": 4,
+    "remove_order": 6,
+    "register": 2,
+}
+
+# large enough for orders to be accepted throughout the log
+stock = 1_000_000_000
+
+# number of results in a page of the searches of the log
+page_size = 20
+
+
+def product_name(rnd):
+    return f"{rnd.choice(brands)} {rnd.choice(adjectives)} {rnd.choice(nouns)} {rnd.randint(1, 999)}"
+
+
+def search_query(rnd):
+    """A query as users type them: a brand, a brand with a word, two words, or a part of a word."""
+    r = rnd.random()
+    if r < 0.4:
+        return rnd.choice(brands)
+    if r < 0.6:
+        return f"{rnd.choice(brands)} {rnd.choice(adjectives)}"
+    if r < 0.95:
+        return f"{rnd.choice(adjectives)} {rnd.choice(nouns)}"
+    noun = rnd.choice(nouns)
+    start = rnd.randrange(len(noun) - 2)
+    return noun[start:start + 3]
+
+
+def price(rnd):
+    return round(int(rnd.lognormvariate(3, 1)) + 0.99, 2)
+
+
+def write_system_file(path, customers, suppliers, products, seed=0):
+    """
+    Write a system file of customers, suppliers and products.
+
+    Args:
+        path (str): The written file.
+        customers (int): Number of customers.
+        suppliers (int): Number of suppliers (at least 1 if there are products).
+        products (int): Number of products.
+        seed (int, optional): Seed of the generated values.
+    """
+    rnd = random.Random(seed)
+
+    def lines():
+        for i in range(customers):
+            yield f"{Customer(i, f'Customer {i}', rnd.choice(cities), f'{rnd.randint(1, 200)} Herzl Street')}\n"
+        for i in range(suppliers):
+            yield f"{Supplier(customers + i, f'Supplier {i}', rnd.choice(cities), f'{i} Industry Road')}\n"
+        for i in range(products):
+            yield f"{Product(i, product_name(rnd), price(rnd), customers + i % suppliers, stock)}\n"
+
+    with open(path, 'w') as file:
+        file.writelines(lines())
+
+
+def write_log(path, customers, suppliers, products, orders, mix=None, seed=0):
+    """
+    Write a command log for the system written by write_system_file with the same counts.
+
+    Args:
+        path (str): The written file.
+        customers, suppliers, products (int): Counts the system file was written with.
+        orders (int): Number of order commands. The other commands are added by their share in mix
+            (commands that can't be valid, e.g. orders when there are no products, are left out).
+        mix (dict, optional): dictionary(command,weight) of order, search, update, add, remove_order
+            and register commands. Defaults to default_mix.
+        seed (int, optional): Seed of the generated values.
+
+    Returns:
+        int: The number of lines written.
+    """
+    mix = default_mix if mix is None else mix
+    if not mix.get("order"):
+        raise ValueError("the command mix must include orders")
+
+    rnd = random.Random(seed)
+    commands = list(mix)
+    weights = list(itertools.accumulate(mix[command] for command in commands))
+    lines_count = round(orders * sum(mix.values()) / mix["order"])
+
+    next_customer = customers + suppliers
+    next_product = products
+    placed = 0
+    written = 0
+    lines = []
+    with open(path, 'w') as file:
+        for command in rnd.choices(commands, cum_weights=weights, k=lines_count):
+            if command == "order" and customers and next_product:
+                placed += 1
+                lines.append(f"order {rnd.randrange(customers)} {rnd.randrange(next_product)} {rnd.randint(1, 3)}\n")
+            elif command == "search":
+                query = search_query(rnd).replace(' ', '_')
+                if rnd.random() < 0.9:
+                    # a page of results, as a shop shows them
+                    lines.append(f"search {query} {rnd.randint(5, 100)} {page_size} {page_size * rnd.choice([0, 0, 0, 1, 2])}\n")
+                else:
+                    lines.append(f"search {query} {rnd.randint(5, 100)}\n")
+            elif command == "update" and next_product and suppliers:
+                product_id = rnd.randrange(next_product)
+                lines.append(f"update {product_id} {product_name(rnd).replace(' ', '_')} {price(rnd)} "
+                             f"{customers + product_id % suppliers} {stock}\n")
+            elif command == "add" and suppliers:
+                lines.append(f"add {next_product} {product_name(rnd).replace(' ', '_')} {price(rnd)} "
+                             f"{customers + next_product % suppliers} {stock}\n")
+                next_product += 1
+            elif command == "remove_order" and placed:
+                lines.append(f"remove order {rnd.randint(1, placed)}\n")
+            elif command == "register":
+                lines.append(f"register customer {next_customer} Customer_{next_customer} "
+                             f"{rnd.choice(cities).replace(' ', '_')} Main_Street\n")
+                next_customer += 1
+            else:
+                continue
+
+            if len(lines) >= 10000:
+                written += len(lines)
+                file.writelines(lines)
+                lines.clear()
+        written += len(lines)
+        file.writelines(lines)
+
+    return written
+
+
+def write_workload(directory, customers, suppliers, products, orders, mix=None, seed=0):
+    """
+    Write system.txt and log.txt into a directory.
+
+    Returns:
+        tuple: (system file path, log file path)
+    """
+    system_path = os.path.join(directory, "system.txt")
+    log_path = os.path.join(directory, "log.txt")
+    write_system_file(system_path, customers, suppliers, products, seed)
+    write_log(log_path, customers, suppliers, products, orders, mix, seed)
+    return system_path, log_path
+
+
+def parse_mix(items):
+    mix = {}
+    for item in items:
+        command, _, weight = item.partition("=")
+        if command not in default_mix or not weight.isdigit():
+            raise argparse.ArgumentTypeError(f"bad command weight {item!r}")
+        mix[command] = int(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-d", required=True, help="directory system.txt and log.txt are written to")
+    parser.add_argument("-c", type=int, default=10_000, help="number of customers")
+    parser.add_argument("-s", type=int, default=1_000, help="number of suppliers")
+    parser.add_argument("-p", type=int, default=100_000, help="number of products")
+    parser.add_argument("-n", type=int, default=100_000, help="number of orders in the log")
+    parser.add_argument("--mix", nargs="+", default=None, metavar="COMMAND=WEIGHT",
+                        help=f"command mix, of {', '.join(default_mix)}")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    mix = None if args.mix is None else parse_mix(args.mix)
+    os.makedirs(args.d, exist_ok=True)
+    system_path, log_path = write_workload(args.d, args.c, args.s, args.p, args.n, mix, args.seed)
+    print(f"wrote {system_path} and {log_path}")
+
+
+if __name__ == "__main__":
+    main()
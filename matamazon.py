@@ -1,7 +1,25 @@
 # TODO add all imports needed here
-import json
 import sys
 import os
+import ast
+import asyncio
+import collections
+import heapq
+import itertools
+import json
+import mmap
+import operator
+import multiprocessing
+import re
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
+from json.encoder import encode_basestring_ascii
 
 
 class InvalidIdException(Exception):
@@ -15,6 +33,37 @@ class InvalidPriceException(Exception):
 default_order_quantity = 1
 default_query_max_price = None
 
+# length of the name substrings kept in the product search index
+name_gram_size = 3
+
+# number of search_products results a MatamazonSystem keeps by default
+default_search_cache_size = 256
+
+# number of log lines parsed together by a worker process of replay_log_parallel
+parse_chunk_size = 10000
+
+# size of the chunks in which read_lines reads files
+read_chunk_size = 1 << 20
+
+# largest number of orders AsyncMatamazonSystem applies together
+async_batch_size = 1024
+
+# number of strings buffered by the order exports between writes to the file
+export_chunk_size = 4096
+
+# group commit of the journal: records are synced to the disk every this many records or seconds
+journal_sync_records = 256
+journal_sync_seconds = 0.05
+
+# binary system snapshots (see MatamazonSystem.export_system_snapshot)
+snapshot_magic = b"MTMZSNAP"
+snapshot_version = 1
+
+# offset indexes of system files, kept next to them (see load_system_from_file(path, lazy=True))
+system_index_magic = b"MTMZINDX"
+system_index_version = 1
+system_index_suffix = ".idx"
+
 
 def check_ids(message, *ids):
     for id in ids:
@@ -22,7 +71,89 @@ def check_ids(message, *ids):
             raise InvalidIdException(message)
 
 
+def _write_orders_json(out_file, orders_by_city):
+    """
+    Write orders grouped by city as a JSON object, piece by piece, byte for byte as
+    json.dump(dictionary(city,list of orders)) would.
+
+    Args:
+        out_file (file-like)
+        orders_by_city (dict): dictionary(city,list of iterables of order strings).
+    """
+    chunk = []
+    city_prefix = "{"
+    for city, city_orders in orders_by_city.items():
+        chunk.append(f"{city_prefix}{encode_basestring_ascii(city)}: [")
+        city_prefix = "], "
+        separator = ""
+        for order_strings in city_orders:
+            for order_string in order_strings:
+                chunk.append(separator)
+                chunk.append(encode_basestring_ascii(order_string))
+                separator = ", "
+                if len(chunk) >= export_chunk_size:
+                    out_file.write("".join(chunk))
+                    chunk.clear()
+
+    chunk.append("{}" if city_prefix == "{" else "]}")
+    out_file.write("".join(chunk))
+
+
+def _write_orders_ndjson(out_file, orders_by_city):
+    """
+    Write orders grouped by city as newline delimited JSON (see MatamazonSystem.export_orders_ndjson).
+
+    Args:
+        out_file (file-like)
+        orders_by_city (dict): dictionary(city,list of iterables of order strings).
+    """
+    chunk = []
+    for city, city_orders in orders_by_city.items():
+        prefix = f'{{"city": {encode_basestring_ascii(city)}, "order": '
+        for order_strings in city_orders:
+            for order_string in order_strings:
+                chunk.append(f"{prefix}{encode_basestring_ascii(order_string)}}}\n")
+                if len(chunk) >= export_chunk_size:
+                    out_file.write("".join(chunk))
+                    chunk.clear()
+
+    out_file.write("".join(chunk))
+
+
+SearchCacheInfo = collections.namedtuple("SearchCacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+def _increment(counts, key):
+    counts[key] = counts.get(key, 0) + 1
+
+
+def _decrement(counts, key):
+    count = counts[key] - 1
+    if count:
+        counts[key] = count
+    else:
+        del counts[key]
+
+
+def _add_amount(totals, key, amount):
+    totals[key] = totals.get(key, 0) + amount
+
+
+def _subtract_amount(totals, key, amount, counts):
+    # the total is dropped with the last order it sums, so no rounding error is left behind
+    if key in counts:
+        totals[key] -= amount
+    else:
+        del totals[key]
+
+
+def _name_grams(name):
+    return {name[i:i + name_gram_size] for i in range(len(name) - name_gram_size + 1)}
+
+
 class Entity:
+    __slots__ = ("id", "name", "city", "address")
+
     def __init__(self, id, name, city, address):
         check_ids(f"{type(self)} ID must be non negative", id)
 
@@ -56,7 +187,7 @@ class Customer(Entity):
     """
 
     # TODO implement this class as instructed
-    pass
+    __slots__ = ()
 
 
 class Supplier(Entity):
@@ -78,7 +209,7 @@ class Supplier(Entity):
     """
 
     # TODO implement this class as instructed
-    pass
+    __slots__ = ()
 
 
 class Product:
@@ -103,6 +234,8 @@ class Product:
             Product(id=101, name='Harry Potter Cushion', price=29.99, supplier_id=42, quantity=555)
     """
 
+    __slots__ = ("id", "name", "price", "supplier_id", "quantity")
+
     def __init__(self, id, name, price, supplier_id, quantity):
         check_ids(f"{type(self)} ID must be non negative", id, supplier_id)
 
@@ -147,6 +280,8 @@ class Order:
 
     """
 
+    __slots__ = ("id", "customer_id", "product_id", "quantity", "total_price")
+
     def __init__(self, id, customer_id, product_id, quantity, total_price):
         check_ids(f"{type(self)} ID must be non negative", id, product_id)
 
@@ -164,6 +299,375 @@ class Order:
         return f"Order(id={self.id}, customer_id={self.customer_id}, product_id={self.product_id}, quantity={self.quantity}, total_price={self.total_price})"
 
 
+class OrderTable(MutableMapping):
+    """
+    A dictionary(id,order) that stores its orders in typed columns instead of Order objects.
+
+    Row i of every column holds the order with ID i, which suits the consecutive IDs given by
+    MatamazonSystem.place_order. An order that doesn't fit the columns (an ID far beyond the
+    last one, or a field that is not a 64-bit int / float) is kept as an object instead.
+
+    Notes:
+        - Orders are created on access, so the same order is returned as different Order objects.
+        - Orders are iterated by ascending ID rather than by insertion order.
+    """
+
+    # largest number of unused rows added to place a single order in the columns
+    max_gap = 1 << 16
+
+    _missing, _float_total, _int_total = 0, 1, 2
+
+    def __init__(self):
+        self._customer_ids = array("q")
+        self._product_ids = array("q")
+        self._quantities = array("q")
+        self._total_prices = array("d")
+        self._kinds = bytearray()  # for every row: _missing, _float_total or _int_total
+        self._count = 0  # number of orders in the columns
+        self._others = {}  # dictionary(id,order) for orders that don't fit in the columns
+
+    def _kind(self, id):
+        if type(id) is int and 0 <= id < len(self._kinds):
+            return self._kinds[id]
+        return self._missing
+
+    def __getitem__(self, id):
+        kind = self._kind(id)
+        if kind == self._missing:
+            return self._others[id]
+
+        total_price = self._total_prices[id]
+        return Order(id, self._customer_ids[id], self._product_ids[id], self._quantities[id],
+                     int(total_price) if kind == self._int_total else total_price)
+
+    def __contains__(self, id):
+        return self._kind(id) != self._missing or id in self._others
+
+    def __setitem__(self, id, order):
+        if id in self:
+            del self[id]
+
+        if not self._store(id, order):
+            self._others[id] = order
+
+    def _store(self, id, order):
+        total_price = order.total_price
+        if type(total_price) is int:
+            if float(total_price) != total_price:
+                return False
+            kind = self._int_total
+        elif type(total_price) is float:
+            kind = self._float_total
+        else:
+            return False
+
+        kinds = self._kinds
+        if not (type(id) is int and 0 <= id <= len(kinds) + self.max_gap):
+            return False
+        if not (type(order.customer_id) is int and type(order.product_id) is int and type(order.quantity) is int):
+            return False
+
+        if id >= len(kinds):
+            grow = id + 1 - len(kinds)
+            for column in self._customer_ids, self._product_ids, self._quantities, self._total_prices:
+                column.frombytes(bytes(grow * column.itemsize))
+            kinds.extend(bytes(grow))
+
+        try:
+            self._customer_ids[id] = order.customer_id
+            self._product_ids[id] = order.product_id
+            self._quantities[id] = order.quantity
+        except OverflowError:
+            return False
+
+        self._total_prices[id] = total_price
+        kinds[id] = kind
+        self._count += 1
+        return True
+
+    def __delitem__(self, id):
+        if self._kind(id) == self._missing:
+            del self._others[id]
+        else:
+            self._kinds[id] = self._missing
+            self._count -= 1
+
+    def __iter__(self):
+        for id, kind in enumerate(self._kinds):
+            if kind:
+                yield id
+        yield from self._others
+
+    def __len__(self):
+        return self._count + len(self._others)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def _load_numpy():
+    """
+    Import NumPy when product columns are first built, so systems without them start without it.
+
+    Returns:
+        module: numpy, or None if it isn't installed (ProductColumns then falls back to Python loops).
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class ProductColumns:
+    """
+    Typed columns of the numeric fields of the products of a MatamazonSystem: ID, price, quantity,
+    supplier ID and seq (the position of the product in the system).
+
+    The columns are array.array objects. When NumPy is installed, filters over them (e.g. the products
+    in stock up to a price, or the products of a supplier) run as vectorized masks over views of the
+    arrays; otherwise they run as Python loops over the arrays.
+
+    Notes:
+        - Rows are not ordered: removing a product moves the last row into its place.
+        - Prices and quantities are kept as floats, which compare like the values of the products.
+    """
+
+    def __init__(self):
+        self.ids = array("q")
+        self.prices = array("d")
+        self.quantities = array("d")
+        self.supplier_ids = array("q")
+        self.seqs = array("q")
+        self._rows = {}  # dictionary(product id,row)
+        self._numpy = _load_numpy()
+        self.vectorized = self._numpy is not None  # whether filters run as NumPy masks
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, product_id):
+        return product_id in self._rows
+
+    def put(self, product, seq):
+        """
+        Add a product, or overwrite the row of a product with the same ID.
+
+        Returns:
+            bool: False if a field of the product doesn't fit in the columns (e.g. an ID beyond 64 bits),
+                in which case the columns are left as they were.
+        """
+        try:
+            values = (int(product.id), float(product.price), float(product.quantity),
+                      int(product.supplier_id), int(seq))
+            array("q", (values[0], values[3], values[4]))
+        except (OverflowError, TypeError, ValueError):
+            return False
+
+        row = self._rows.get(product.id)
+        if row is None:
+            self._rows[product.id] = len(self.ids)
+            for column, value in zip(self._columns(), values):
+                column.append(value)
+        else:
+            for column, value in zip(self._columns(), values):
+                column[row] = value
+        return True
+
+    def _columns(self):
+        return self.ids, self.prices, self.quantities, self.supplier_ids, self.seqs
+
+    def remove(self, product_id):
+        row = self._rows.pop(product_id)
+        last = len(self.ids) - 1
+        for column in self._columns():
+            if row != last:
+                column[row] = column[last]
+            column.pop()
+        if row != last:
+            self._rows[self.ids[row]] = row
+
+    def set_price(self, product_id, price):
+        self.prices[self._rows[product_id]] = price
+
+    def set_quantity(self, product_id, quantity):
+        self.quantities[self._rows[product_id]] = quantity
+
+    def in_stock_by_price(self, max_price=None):
+        """
+        IDs of the products in stock (quantity > 0) up to max_price.
+
+        Returns:
+            list[int]: The product IDs, ordered by price and then by seq.
+        """
+        if not self.ids:
+            return []
+
+        numpy = self._numpy
+        if numpy is not None:
+            prices = numpy.frombuffer(self.prices, dtype=numpy.float64)
+            mask = numpy.frombuffer(self.quantities, dtype=numpy.float64) > 0
+            if max_price is not None:
+                mask &= prices <= max_price
+            rows = numpy.flatnonzero(mask)
+            rows = rows[numpy.lexsort((numpy.frombuffer(self.seqs, dtype=numpy.int64)[rows], prices[rows]))]
+            return numpy.frombuffer(self.ids, dtype=numpy.int64)[rows].tolist()
+
+        prices, quantities, seqs = self.prices, self.quantities, self.seqs
+        rows = [row for row in range(len(prices))
+                if quantities[row] > 0 and (max_price is None or prices[row] <= max_price)]
+        rows.sort(key=lambda row: (prices[row], seqs[row]))
+        return [self.ids[row] for row in rows]
+
+    def _supplier_rows(self, supplier_id):
+        if not self.ids or not (type(supplier_id) is int and -1 << 63 <= supplier_id < 1 << 63):
+            return []
+        numpy = self._numpy
+        if numpy is not None:
+            return numpy.flatnonzero(numpy.frombuffer(self.supplier_ids, dtype=numpy.int64) == supplier_id)
+        return [row for row, row_supplier_id in enumerate(self.supplier_ids) if row_supplier_id == supplier_id]
+
+    def supplier_products(self, supplier_id):
+        """
+        IDs of the products of a supplier.
+
+        Returns:
+            list[int]: The product IDs, in row order.
+        """
+        rows = self._supplier_rows(supplier_id)
+        numpy = self._numpy
+        if numpy is not None and len(rows):
+            return numpy.frombuffer(self.ids, dtype=numpy.int64)[rows].tolist()
+        return [self.ids[row] for row in rows]
+
+    def scale_prices(self, supplier_id, factor):
+        """
+        Multiply the prices of the products of a supplier by a factor.
+
+        Returns:
+            tuple: (list of product IDs, list of their new prices), in row order.
+        """
+        rows = self._supplier_rows(supplier_id)
+        numpy = self._numpy
+        if numpy is not None and len(rows):
+            prices = numpy.frombuffer(self.prices, dtype=numpy.float64)
+            prices[rows] *= factor
+            return (numpy.frombuffer(self.ids, dtype=numpy.int64)[rows].tolist(), prices[rows].tolist())
+
+        prices = self.prices
+        for row in rows:
+            prices[row] *= factor
+        return [self.ids[row] for row in rows], [prices[row] for row in rows]
+
+
+class LazyObjects(MutableMapping):
+    """
+    A dictionary(id,object) of the customers, suppliers or products of a system file, which reads the
+    line of an object only when the object is first accessed (see load_system_from_file(path, lazy=True)).
+
+    The objects of the file that were not accessed yet are kept as the offset and length of their line,
+    in array columns sorted by ID, so looking one up takes a binary search and no dictionary of the
+    whole file is built. Accessed objects and objects added later are kept in dictionaries.
+
+    Notes:
+        - The file must not change while the mapping is in use.
+        - Iterated like the dictionary load_system_from_file fills: the objects of the file by the
+          order of their first line, then the objects added later by the order they were added.
+    """
+
+    def __init__(self, source, ids, offsets, lengths, sorted_ids, sorted_rows):
+        """
+        Args:
+            source: The contents of the system file (e.g. a memory map).
+            ids, offsets, lengths: array columns of the objects of the file, by the order of their
+                first line: ID, and the offset and length of their (last) line.
+            sorted_ids, sorted_rows: The IDs sorted, and the row of every sorted ID in the columns.
+        """
+        self._source = source
+        self._ids = ids
+        self._offsets = offsets
+        self._lengths = lengths
+        self._sorted_ids = sorted_ids
+        self._sorted_rows = sorted_rows
+        self._objects = {}  # dictionary(id,object) of the objects of the file that were accessed
+        self._removed = set()  # ids of the objects of the file that were removed
+        # dictionary(id,object) of the objects added after the file was read, including objects of
+        # the file that were removed and added again
+        self._added = {}
+
+    def position(self, id):
+        """
+        Position of the line of an object of the file among the objects of the file.
+
+        Returns:
+            int | None: The position, or None if the object is not in the file or was removed.
+        """
+        try:
+            i = bisect_left(self._sorted_ids, id)
+        except TypeError:
+            return None
+
+        if i < len(self._sorted_ids) and self._sorted_ids[i] == id and id not in self._removed:
+            return self._sorted_rows[i]
+        return None
+
+    def __getitem__(self, id):
+        obj = self._added.get(id)
+        if obj is None:
+            obj = self._objects.get(id)
+        if obj is None:
+            row = self.position(id)
+            if row is None:
+                raise KeyError(id)
+
+            offset = self._offsets[row]
+            obj = parse_object_line(self._source[offset:offset + self._lengths[row]].decode().strip())
+            self._objects[id] = obj
+        return obj
+
+    def __contains__(self, id):
+        return id in self._added or id in self._objects or self.position(id) is not None
+
+    def __setitem__(self, id, obj):
+        if id in self._added or self.position(id) is None:
+            self._added[id] = obj
+        else:
+            self._objects[id] = obj
+
+    def __delitem__(self, id):
+        if id in self._added:
+            del self._added[id]
+        elif self.position(id) is not None:
+            self._objects.pop(id, None)
+            self._removed.add(id)
+        else:
+            raise KeyError(id)
+
+    def restore(self, id, obj):
+        """
+        Put back a removed object: an object of the file goes back to its position, and any other
+        object is added as by setting it.
+        """
+        if id in self._removed:
+            self._removed.discard(id)
+            self._objects[id] = obj
+        else:
+            self._added[id] = obj
+
+    def __iter__(self):
+        removed = self._removed
+        for id in self._ids:
+            if id not in removed:
+                yield id
+        yield from self._added
+
+    def __len__(self):
+        return len(self._ids) - len(self._removed) + len(self._added)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 class MatamazonSystem:
     """
     Main system class that stores and manages customers, suppliers, products and orders.
@@ -183,10 +687,19 @@ class MatamazonSystem:
         - A parameterless constructor is required.
     """
 
-    def __init__(self):
+    def __init__(self, compact_orders=False, search_cache_size=default_search_cache_size, product_columns=False):
         """
         Initialize an empty Matamazon system.
 
+        Args:
+            compact_orders (bool, optional): Store the orders in an OrderTable, which takes a fraction of
+                the memory of Order objects. Defaults to False.
+            search_cache_size (int, optional): Number of search_products results kept for repeated
+                searches, or 0 to search every time. Defaults to default_search_cache_size.
+            product_columns (bool, optional): Keep the numeric fields of the products in ProductColumns
+                too, which filters them by price, stock and supplier with vectorized masks when NumPy
+                is installed. Defaults to False.
+
         Requirements:
             - Must be parameterless.
             - Internal collections may be chosen freely (dict/list, etc.).
@@ -195,9 +708,55 @@ class MatamazonSystem:
         self.customers = {}  # dictionary(id,costumer)
         self.suppliers = {}  # dictionary(id,supplier)
         self.products = {}  # dictionary(id,product)
-        self.orders = {}  # dictionary(id,order)
+        self.orders = OrderTable() if compact_orders else {}  # dictionary(id,order)
         self.next_id = 1
 
+        # reverse dependency indexes, so removals don't need to scan the orders
+        self._customer_orders = {}  # dictionary(customer id,number of orders)
+        self._product_orders = {}  # dictionary(product id,number of orders)
+        # dictionary(supplier id,dictionary(order id,order string or None until the order is exported)),
+        # so export_orders doesn't join every order with its product and supplier again
+        self._supplier_orders = {}
+        self._unformatted_suppliers = set()  # suppliers with orders that were not formatted yet
+
+        # running aggregates of the orders, for the analytics queries
+        self._supplier_revenue = {}  # dictionary(supplier id,total price of the orders of its products)
+        self._product_units = {}  # dictionary(product id,ordered quantity)
+        self._customer_spend = {}  # dictionary(customer id,total price of its orders)
+        # a formatted order takes more memory than a compact one, so compact systems don't keep them
+        self._cache_order_strings = not compact_orders
+
+        # product search index
+        self._name_index = {}  # dictionary(name trigram,set of product ids)
+        self._product_seq = {}  # dictionary(product id,position of the product in self.products)
+        self._next_product_seq = 0
+        self._products_by_price = []  # sorted list of (price, product seq, product id)
+        self._columns = ProductColumns() if product_columns else None
+
+        # LRU cache of search_products results
+        self._search_cache = collections.OrderedDict()  # dictionary((query, max_price),tuple of products)
+        self._search_cache_size = search_cache_size
+        self._search_hits = 0
+        self._search_misses = 0
+        # changed whenever a search result may change, so a search that ran meanwhile isn't cached
+        self._search_version = 0
+
+        self.journal = None  # the Journal mutations are recorded in, if any
+        # (class name, id) of the customers, suppliers and products changed since the last export of the
+        # system file, or None until changes are tracked (see export_system_delta)
+        self._dirty = None
+        self._removed_products = set()  # ids of the tracked products that were removed (and maybe added again)
+        # True while self.products is the LazyObjects of a lazily loaded system file and the product
+        # indexes are not built yet (see _load_lazy_products)
+        self._lazy = False
+        # undo log of the open transaction: (name of the method undoing a change, its arguments...),
+        # or None outside transactions (see transaction)
+        self._undo = None
+        # (undo log length, next_id, next product seq, deferred journal records) of every open transaction
+        self._savepoints = []
+        self._transaction_journal = None  # the journal of the system while a transaction defers its records
+        self.metrics = None  # the Metrics calls are recorded in, if enabled (see enable_metrics)
+
     def register_entity(self, entity, is_customer):
         """
         Register a Customer or Supplier in the system.
@@ -224,6 +783,13 @@ class MatamazonSystem:
                 raise InvalidIdException(f"Supplier id {entity.id} is already taken.")
             self.suppliers[entity.id] = entity
 
+        if self._dirty is not None:
+            self._dirty.add(("Customer" if is_customer else "Supplier", entity.id))
+        if self._undo is not None:
+            self._undo.append(("_undo_register", entity.id, is_customer))
+        if self.journal is not None:
+            self.journal.record("register", is_customer, entity.id, entity.name, entity.city, entity.address)
+
     def add_or_update_product(self, product):
         """
         Add a new product or update an existing product.
@@ -244,6 +810,17 @@ class MatamazonSystem:
                 - If attempting to update a product but supplier_id differs from the existing product.
         """
         # TODO implement this method as instructed
+        self._check_product(product)
+
+        # the supplier of a product never changes, so the order counts of the product and its
+        # supplier stay valid when the product is replaced
+        self._store_product(product)
+
+        if self.journal is not None:
+            self.journal.record("product", product.id, product.name, product.price, product.supplier_id,
+                                product.quantity)
+
+    def _check_product(self, product):
         if product.supplier_id not in self.suppliers:
             raise InvalidIdException(
                 f"Product {product} is given with supplier id {product.supplier_id} that matches no supplier.")
@@ -252,9 +829,144 @@ class MatamazonSystem:
             old_product = self.products[product.id]
             if old_product.supplier_id != product.supplier_id:
                 raise InvalidIdException(f"Product {product} is given with un matching supplier id")
-            self.products[product.id] = product
+
+    def _store_product(self, product, price_entries=None):
+        """
+        Put a product in self.products (replacing a product with the same ID) and index it.
+
+        Args:
+            product: A Product object. Its supplier is not validated.
+            price_entries (dict, optional): If given, the price list is left as it is: the entry of the
+                product is put in this dictionary(product id,price list entry), and the caller must take
+                the entry of a replaced product out of the list and add the new entries.
+        """
+        old_product = self.products.get(product.id)
+        if old_product is None:
+            self._product_seq[product.id] = self._next_product_seq
+            self._next_product_seq += 1
         else:
-            self.products[product.id] = product
+            self._unindex_product(old_product, in_price_list=price_entries is None)
+
+        self.products[product.id] = product
+        self._index_product(product, price_entries)
+        if self._undo is not None:
+            self._undo.append(("_undo_store_product", product, old_product))
+
+    def _store_products(self, products):
+        """
+        Store many products like _store_product, updating the price list once for the whole batch
+        instead of once per product.
+
+        Args:
+            products: An iterable of Product objects.
+        """
+        by_price = self._products_by_price
+        entries = {}  # dictionary(product id,price list entry) of the stored products
+        stale = []  # price list entries of the replaced products
+        try:
+            for product in products:
+                old_product = self.products.get(product.id)
+                if old_product is not None and product.id not in entries and not self._lazy:
+                    stale.append((old_product.price, self._product_seq[product.id], product.id))
+                self._store_product(product, entries)
+        finally:
+            # (also when the products raise, so a rolled back transaction finds them in the list)
+            if len(stale) > len(by_price) // 64:
+                # many replaced products are taken out of the list in one pass
+                replaced = {entry[2] for entry in stale}
+                by_price[:] = [entry for entry in by_price if entry[2] not in replaced]
+            else:
+                for entry in stale:
+                    del by_price[bisect_left(by_price, entry)]
+            if entries:
+                by_price.extend(entries.values())
+                by_price.sort()
+
+    def _index_product(self, product, price_entries=None):
+        if product.quantity > 0:
+            self._invalidate_searches(product)
+        if self._dirty is not None:
+            self._dirty.add(("Product", product.id))
+        if self._lazy:
+            return
+
+        entry = (product.price, self._product_seq[product.id], product.id)
+        if price_entries is None:
+            insort(self._products_by_price, entry)
+        else:
+            price_entries[product.id] = entry
+
+        if self._columns is not None and not self._columns.put(product, entry[1]):
+            # a product that doesn't fit the columns turns them off
+            self._columns = None
+
+        name_index = self._name_index
+        for gram in _name_grams(product.name):
+            ids = name_index.get(gram)
+            if ids is None:
+                name_index[gram] = {product.id}
+            else:
+                ids.add(product.id)
+
+    def _unindex_product(self, product, in_price_list=True):
+        if product.quantity > 0:
+            self._invalidate_searches(product)
+        if self._dirty is not None:
+            self._dirty.add(("Product", product.id))
+        if self._lazy:
+            return
+
+        if in_price_list:
+            entry = (product.price, self._product_seq[product.id], product.id)
+            del self._products_by_price[bisect_left(self._products_by_price, entry)]
+        if self._columns is not None:
+            self._columns.remove(product.id)
+
+        for gram in _name_grams(product.name):
+            ids = self._name_index[gram]
+            ids.discard(product.id)
+            if not ids:
+                del self._name_index[gram]
+
+    def _load_lazy_products(self):
+        """
+        Read all the products of a lazily loaded system file and build the product indexes, which
+        searches and repricing need. Does nothing if the products were loaded already.
+        """
+        if not self._lazy:
+            return
+
+        lazy_products = self.products
+        products = list(lazy_products.values())
+        for product in products:
+            self._product_seq[product.id] = self._seq(product.id)
+        self._lazy = False
+        self.products = {product.id: product for product in products}
+
+        # reading the file is not a change of the products
+        dirty, self._dirty = self._dirty, None
+        entries = {}
+        try:
+            for product in products:
+                self._index_product(product, entries)
+        finally:
+            self._products_by_price.extend(entries.values())
+            self._products_by_price.sort()
+            self._dirty = dirty
+
+    def _seq(self, product_id):
+        """
+        Position of a product in self.products, which orders the products of the same price.
+
+        Returns:
+            int | None: The seq of the product, or None if it is not in the system.
+        """
+        seq = self._product_seq.get(product_id)
+        if seq is None and self._lazy:
+            # the products of a lazily loaded file have no seq until they are all read, and are
+            # ordered by their position in the file, before the products added since
+            seq = self.products.position(product_id)
+        return seq
 
     def place_order(self, customer_id, product_id, quantity = default_order_quantity):
         """
@@ -284,26 +996,100 @@ class MatamazonSystem:
             - The specification assumes quantity is an integer.
         """
         # TODO implement this method as instructed
-        if product_id not in self.products:
-            return "The product does not exist in the system"
+        product, message = self._take_stock(product_id, quantity)
+        if product is not None:
+            self._add_order(customer_id, product, quantity)
+        return message
+
+    def _take_stock(self, product_id, quantity):
+        """
+        Check that an order can be placed, and if so decrease the product stock.
+
+        Returns:
+            tuple: (product, status message) - product is None if the order can't be placed.
+        """
+        product = self.products.get(product_id)
+        if product is None:
+            return None, "The product does not exist in the system"
 
-        product = self.products[product_id]
         if quantity > product.quantity:
-            return "The quantity requested for this product is greater than the quantity in stock."
+            return None, "The quantity requested for this product is greater than the quantity in stock."
 
         product.quantity -= quantity
+        if self._columns is not None:
+            self._columns.set_quantity(product.id, product.quantity)
+        if self._undo is not None:
+            self._undo.append(("_change_stock", product, quantity))
+        return product, "The order has been accepted in the system"
+
+    def _add_order(self, customer_id, product, quantity):
+        """
+        Create and store the order of an accepted place_order, whose stock was already taken.
+        """
         total_price = product.price * quantity
         order = Order(
             id=self.next_id,
             customer_id=customer_id,
-            product_id=product_id,
+            product_id=product.id,
             quantity=quantity,
             total_price=total_price
         )
 
         self.orders[order.id] = order
+        self._index_order(order, product.supplier_id)
         self.next_id += 1
-        return "The order has been accepted in the system"
+        if self._undo is not None:
+            self._undo.append(("_undo_order", order.id))
+
+        if (product.quantity > 0) != (product.quantity + quantity > 0):
+            # the product ran out of stock (or, for a negative quantity, came back in stock)
+            self._invalidate_searches(product)
+        if self._dirty is not None:
+            self._dirty.add(("Product", product.id))
+
+        if self.journal is not None:
+            self.journal.record("order", customer_id, product.id, quantity)
+
+    def _index_order(self, order, supplier_id):
+        """
+        Add a stored order to the reverse dependency indexes.
+
+        Args:
+            order: The Order that was added to self.orders.
+            supplier_id (int): Supplier of the ordered product.
+        """
+        _increment(self._customer_orders, order.customer_id)
+        _increment(self._product_orders, order.product_id)
+        _add_amount(self._customer_spend, order.customer_id, order.total_price)
+        _add_amount(self._product_units, order.product_id, order.quantity)
+        _add_amount(self._supplier_revenue, supplier_id, order.total_price)
+
+        supplier_orders = self._supplier_orders.get(supplier_id)
+        if supplier_orders is None:
+            self._supplier_orders[supplier_id] = {order.id: None}
+        else:
+            supplier_orders[order.id] = None
+        self._unformatted_suppliers.add(supplier_id)
+
+    def _unindex_order(self, order):
+        """
+        Remove an order that was popped from self.orders from the reverse dependency indexes.
+
+        Args:
+            order: The removed Order. Its product must still be in the system.
+        """
+        _decrement(self._customer_orders, order.customer_id)
+        _decrement(self._product_orders, order.product_id)
+        _subtract_amount(self._customer_spend, order.customer_id, order.total_price, self._customer_orders)
+        _subtract_amount(self._product_units, order.product_id, order.quantity, self._product_orders)
+
+        supplier_id = self.products[order.product_id].supplier_id
+        supplier_orders = self._supplier_orders[supplier_id]
+        del supplier_orders[order.id]
+        if not supplier_orders:
+            del self._supplier_orders[supplier_id]
+            self._unformatted_suppliers.discard(supplier_id)
+        _subtract_amount(self._supplier_revenue, supplier_id, order.total_price, self._supplier_orders)
 
     def remove_object(self, _id, class_type):
 
@@ -333,194 +1119,2680 @@ class MatamazonSystem:
         if class_type_clean == "order":
             if _id in self.orders:
                 order = self.orders.pop(_id)
-                if order.product_id in self.products:
-                    self.products[order.product_id].quantity += order.quantity
+                # an order's product can't be removed while the order exists
+                self._unindex_order(order)
+                self._change_stock(self.products[order.product_id], order.quantity)
+                if self._undo is not None:
+                    self._undo.append(("_restore_order", order))
+                if self.journal is not None:
+                    self.journal.record("remove", _id, class_type)
                 return order.quantity
             return None
 
         elif class_type_clean == "customer":
-            for order in self.orders.values():
-                if order.customer_id == _id:
-                    raise InvalidIdException("Cannot remove customer - still in use in existing orders")
+            if _id in self._customer_orders:
+                raise InvalidIdException("Cannot remove customer - still in use in existing orders")
 
             if _id in self.customers:
-                del self.customers[_id]
+                customer = self.customers.pop(_id)
+                if self._dirty is not None:
+                    self._dirty.add(("Customer", _id))
+                if self._undo is not None:
+                    self._undo.append(("_restore_entity", customer, True))
+                if self.journal is not None:
+                    self.journal.record("remove", _id, class_type)
 
         elif class_type_clean == "supplier":
-            for order in self.orders.values():
-
-                if order.product_id not in self.products:
-                    continue
-
-                order_product = self.products[order.product_id]
-                if order_product.supplier_id == _id:
-                    raise InvalidIdException("Cannot remove supplier - still in use in existing orders")
+            if _id in self._supplier_orders:
+                raise InvalidIdException("Cannot remove supplier - still in use in existing orders")
 
             if _id in self.suppliers:
-                del self.suppliers[_id]
+                supplier = self.suppliers.pop(_id)
+                if self._dirty is not None:
+                    self._dirty.add(("Supplier", _id))
+                if self._undo is not None:
+                    self._undo.append(("_restore_entity", supplier, False))
+                if self.journal is not None:
+                    self.journal.record("remove", _id, class_type)
 
         elif class_type_clean == "product":
-            for order in self.orders.values():
-                if order.product_id == _id:
-                    raise InvalidIdException("Cannot remove product - still in use in existing orders")
+            if _id in self._product_orders:
+                raise InvalidIdException("Cannot remove product - still in use in existing orders")
 
             if _id in self.products:
-                del self.products[_id]
+                seq = self._seq(_id)
+                product = self.products.pop(_id)
+                self._unindex_product(product)
+                # (the products of a lazily loaded file have no seq until they are all read)
+                self._product_seq.pop(_id, None)
+                if self._undo is not None:
+                    self._undo.append(("_restore_product", product, seq, _id in self._removed_products))
+                if self._dirty is not None:
+                    self._removed_products.add(_id)
+                if self.journal is not None:
+                    self.journal.record("remove", _id, class_type)
 
         return None
 
-    def search_products(self, query, max_price = default_query_max_price):
+    def reprice(self, supplier_id, factor):
         """
-        Search products by query in the product name, and optionally filter by max_price.
+        Multiply the prices of all the products of a supplier by a factor.
 
         Args:
-            query (str): Product name or part of product name.
-            max_price (float, optional): If provided, only return products with price <= max_price.
+            supplier_id (int): Supplier ID.
+            factor (float): Non-negative factor. The new prices are floats.
 
         Returns:
-            list[Product]:
-                - Products that match the query and have quantity != 0,
-                - Sorted by ascending price.
-                - If no matching products exist, return an empty list.
+            int: The number of repriced products.
+
+        Raises:
+            InvalidIdException: If the supplier does not exist in the system.
+            InvalidPriceException: If the factor is negative.
         """
-        # TODO implement this method as instructed
-        result = []
-        for product in self.products.values():
-            if product.quantity <= 0:
-                continue
+        self._check_supplier(supplier_id)
+        if factor < 0:
+            raise InvalidPriceException(f"{__name__} Price must be non negative")
+
+        self._load_lazy_products()
+        if self._columns is not None:
+            product_ids, prices = self._columns.scale_prices(supplier_id, factor)
+            products = [self.products[product_id] for product_id in product_ids]
+        else:
+            products = self._supplier_products(supplier_id)
+            prices = [float(product.price) * factor for product in products]
 
-            if query in product.name:
-                if max_price is None:
-                    result.append(product)
-                elif product.price <= max_price:
-                    result.append(product)
+        if self._undo is not None:
+            self._undo.append(("_restore_prices", products, [product.price for product in products]))
+        self._set_prices(products, prices)
 
-        return sorted(result)
+        if self.journal is not None:
+            self.journal.record("reprice", supplier_id, factor)
+        return len(products)
 
-    def export_system_to_file(self, path):
+    def restock(self, supplier_id, quantity):
         """
-        Export system state (customers, suppliers, products) to a text file.
+        Add stock to all the products of a supplier.
 
         Args:
-            path (str): Output file path.
+            supplier_id (int): Supplier ID.
+            quantity (int): Non-negative quantity added to the stock of every product.
 
-        Behavior:
-            - Write each object on its own line, using the object's print/str representation.
-            - Orders must NOT be included.
-            - No constraint on the ordering of objects in the output.
+        Returns:
+            int: The number of restocked products.
 
         Raises:
-            OSError (or any file-open exception): Must be propagated to the caller.
+            InvalidIdException: If the supplier does not exist in the system.
+            ValueError: If the quantity is negative.
         """
-        # TODO implement this method as instructed
-        try:
-            with open(path, 'w') as file:
-                for customer in self.customers.values():
-                    file.write(f"{customer}\n")
+        self._check_supplier(supplier_id)
+        if quantity < 0:
+            raise ValueError(f"Restocked quantity {quantity} must be non negative")
 
-                for supplier in self.suppliers.values():
-                    file.write(f"{supplier}\n")
+        products = self._supplier_products(supplier_id)
+        for product in products:
+            self._change_stock(product, quantity)
+        if self._undo is not None:
+            self._undo.append(("_undo_restock", products, quantity))
 
-                for product in self.products.values():
-                    file.write(f"{product}\n")
-        except Exception as e:
-            raise e
+        if self.journal is not None:
+            self.journal.record("restock", supplier_id, quantity)
+        return len(products)
 
-    def export_orders(self, out_file):
+    def _change_stock(self, product, quantity):
         """
-        Export orders in JSON format grouped by origin city.
+        Add a (possibly negative) quantity to the stock of a product, keeping the columns, the search
+        cache and the changed products in sync.
+        """
+        was_in_stock = product.quantity > 0
+        product.quantity += quantity
+        if self._columns is not None:
+            self._columns.set_quantity(product.id, product.quantity)
+        if was_in_stock != (product.quantity > 0):
+            self._invalidate_searches(product)
+        if self._dirty is not None:
+            self._dirty.add(("Product", product.id))
+
+    def _check_supplier(self, supplier_id):
+        if supplier_id not in self.suppliers:
+            raise InvalidIdException(f"Supplier id {supplier_id} matches no supplier.")
+
+    def _supplier_products(self, supplier_id):
+        if self._columns is not None:
+            return [self.products[product_id] for product_id in self._columns.supplier_products(supplier_id)]
+        return [product for product in self.products.values() if product.supplier_id == supplier_id]
+
+    def _set_prices(self, products, prices):
+        """
+        Change the prices of many products, keeping the price list and the search cache in sync.
 
         Args:
-            out_file (file-like)
-
-        Behavior (per specification):
-            - Produce a JSON object where:
-                - Keys: origin city (supplier city) for each order.
-                - Values: list of strings representing orders (format as specified in section 4.1.4).
-            - Order lists can be in any order.
-            - No requirement on key ordering.
+            products: A list of products in the system.
+            prices: Their new prices, in the same order. The price columns must already hold them.
+        """
+        if len(products) > len(self._search_cache):
+            # cheaper than matching every product with every cached search
+            self._search_cache.clear()
+            self._search_version += 1
+        else:
+            for product in products:
+                if product.quantity > 0:
+                    self._invalidate_searches(product)
+
+        by_price = self._products_by_price
+        product_seq = self._product_seq
+        # many products are taken out of the price list in one pass and sorted back in
+        rebuild = len(products) > len(by_price) // 64
+        if rebuild:
+            repriced = {product.id for product in products}
+            by_price[:] = [entry for entry in by_price if entry[2] not in repriced]
+        else:
+            for product in products:
+                del by_price[bisect_left(by_price, (product.price, product_seq[product.id], product.id))]
+
+        for product, price in zip(products, prices):
+            product.price = price
+            if self._dirty is not None:
+                self._dirty.add(("Product", product.id))
+            entry = (price, product_seq[product.id], product.id)
+            if rebuild:
+                by_price.append(entry)
+            else:
+                insort(by_price, entry)
+            if product.quantity > 0:
+                self._invalidate_searches(product)
 
-        Raises:
-            Any exception during writing: Must be propagated to the caller.
+        if rebuild:
+            by_price.sort()
 
-        Notes:
-            - The order origin city is the supplier city of the ordered product.
+    def register_many(self, entities):
         """
-        # TODO implement this method as instructed
-        sorted_by_city = {}
-
-        for order in self.orders.values():
-            if order.product_id not in self.products:
-                continue
+        Register many customers and suppliers, as by register_entity for each of them in order.
 
-            product = self.products[order.product_id]
-            if product.supplier_id not in self.suppliers:
-                continue
+        Args:
+            entities: An iterable of (entity, is_customer) pairs.
 
-            supplier = self.suppliers[product.supplier_id]
-            if supplier.city not in sorted_by_city:
-                sorted_by_city[supplier.city] = []
+        Returns:
+            list: For every entity, None if it was registered, or the InvalidIdException that
+                register_entity raised for it.
+        """
+        register_entity = self.register_entity
+        results = []
+        for entity, is_customer in entities:
+            try:
+                register_entity(entity, is_customer)
+            except InvalidIdException as e:
+                results.append(e)
+            else:
+                results.append(None)
 
-            sorted_by_city[supplier.city].append(f"{order}")
+        return results
 
-        try:
-            json.dump(sorted_by_city, out_file)
-        except Exception as e:
-            raise e
+    def upsert_products(self, products):
+        """
+        Add or update many products, as by add_or_update_product for each of them in order.
 
+        The price list is updated once for the whole batch instead of once per product.
 
-def load_system_from_file(path):
-    """
-    Load a MatamazonSystem from an input file.
+        Args:
+            products: An iterable of Product objects.
+
+        Returns:
+            list: For every product, None if it was stored, or the InvalidIdException that
+                add_or_update_product raised for it.
+        """
+        results = []
+
+        def valid_products():
+            # checked lazily, so a product is checked against the ones stored before it
+            for product in products:
+                try:
+                    self._check_product(product)
+                except InvalidIdException as e:
+                    results.append(e)
+                    continue
+
+                results.append(None)
+                yield product
+
+                # resumed once the product is stored, so the journal (and a checkpoint it may take)
+                # never gets ahead of the system
+                if self.journal is not None:
+                    self.journal.record("product", product.id, product.name, product.price, product.supplier_id,
+                                        product.quantity)
+
+        self._store_products(valid_products())
+        return results
+
+    def place_orders(self, orders):
+        """
+        Place many orders, as by place_order for each of them in order.
+
+        Args:
+            orders: An iterable of (customer_id, product_id) or (customer_id, product_id, quantity) tuples.
+
+        Returns:
+            list[str]: The status message of every order.
+        """
+        place_order = self.place_order
+        return [place_order(*order) for order in orders]
+
+    def remove_many(self, objects):
+        """
+        Remove many objects, as by remove_object for each of them in order.
+
+        Args:
+            objects: An iterable of (_id, class_type) pairs.
+
+        Returns:
+            list: For every object, the value remove_object returned for it, or the InvalidIdException
+                it raised.
+        """
+        remove_object = self.remove_object
+        results = []
+        for _id, class_type in objects:
+            try:
+                results.append(remove_object(_id, class_type))
+            except InvalidIdException as e:
+                results.append(e)
+
+        return results
+
+    def _checkpoint_due(self):
+        """
+        Called by the journal once checkpoint_records records were written since its last checkpoint.
+        """
+        self.journal.checkpoint()
+
+    def _all_locks(self):
+        """
+        A context in which no other thread uses the system (see ConcurrentMatamazonSystem).
+        """
+        return nullcontext()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Apply a group of changes to the system together, or not at all.
+
+        Used as:
+            with system.transaction():
+                system.place_order(1, 101, 2)
+                system.place_order(1, 102)
+
+        If the block raises, every change made in it is rolled back and the exception is propagated.
+        Transactions may be nested: an inner transaction is a savepoint, rolled back alone if its block
+        raises, whose changes are kept only if the outer transaction commits.
+
+        Yields:
+            MatamazonSystem: The system.
+
+        Behavior:
+            - Changes are recorded in an undo log as they are made (e.g. the ID of a placed order, or
+              the product that a new version replaced) instead of copying the system. A rollback undoes
+              them in reverse order through the internal operations that made them, so the indexes,
+              aggregates, product columns, search cache and changed objects (see export_system_delta)
+              follow, and the next order ID is restored.
+            - The journal records of the changes are written when the outermost transaction commits,
+              and dropped when it rolls back.
+
+        Notes:
+            - Failures that are returned rather than raised (e.g. by register_many, or a status message
+              of place_order) don't roll anything back.
+            - A customer or supplier whose removal was rolled back is exported after the others by
+              export_system_to_file.
+        """
+        self._begin()
+        try:
+            yield self
+        except BaseException:
+            self._rollback()
+            raise
+        self._commit()
+
+    def _begin(self):
+        if self._undo is None:
+            self._undo = []
+            if self.journal is not None:
+                self._transaction_journal, self.journal = self.journal, _DeferredRecords()
+
+        deferred = 0 if self._transaction_journal is None else len(self.journal)
+        self._savepoints.append((len(self._undo), self.next_id, self._next_product_seq, deferred))
+
+    def _commit(self):
+        self._savepoints.pop()
+        if self._savepoints:
+            # a savepoint - its changes are rolled back with the outer transaction
+            return
+
+        self._undo = None
+        journal = self._transaction_journal
+        if journal is not None:
+            records, self.journal, self._transaction_journal = self.journal, journal, None
+            # as one group, so a checkpoint isn't taken between them (it would hold the records after it)
+            journal.record_many(records)
+
+    def _rollback(self):
+        undo_length, next_id, next_product_seq, deferred = self._savepoints.pop()
+        undo = self._undo
+        restored_products = False
+        restored_suppliers = set()  # suppliers with orders that were put back
+        while len(undo) > undo_length:
+            name, *args = undo.pop()
+            getattr(self, name)(*args)
+            if name == "_restore_product":
+                restored_products = True
+            elif name == "_restore_order":
+                restored_suppliers.add(self.products[args[0].product_id].supplier_id)
+
+        self.next_id = next_id
+        self._next_product_seq = next_product_seq
+        # put the restored objects back in their positions: products by seq, and orders by ID
+        if restored_products and not self._lazy:
+            products = sorted(self.products.items(), key=lambda item: self._product_seq[item[0]])
+            self.products.clear()
+            self.products.update(products)
+        for supplier_id in restored_suppliers:
+            supplier_orders = self._supplier_orders.get(supplier_id)
+            if supplier_orders:
+                order_strings = sorted(supplier_orders.items())
+                supplier_orders.clear()
+                supplier_orders.update(order_strings)
+
+        if self._transaction_journal is not None:
+            del self.journal[deferred:]
+        if not self._savepoints:
+            self._undo = None
+            if self._transaction_journal is not None:
+                self.journal, self._transaction_journal = self._transaction_journal, None
+
+    def _undo_register(self, id, is_customer):
+        del (self.customers if is_customer else self.suppliers)[id]
+        if self._dirty is not None:
+            self._dirty.add(("Customer" if is_customer else "Supplier", id))
+
+    def _restore_entity(self, entity, is_customer):
+        (self.customers if is_customer else self.suppliers)[entity.id] = entity
+        if self._dirty is not None:
+            self._dirty.add(("Customer" if is_customer else "Supplier", entity.id))
+
+    def _undo_store_product(self, product, old_product):
+        self._unindex_product(product)
+        if old_product is None:
+            del self.products[product.id]
+            self._product_seq.pop(product.id, None)
+        else:
+            self.products[product.id] = old_product
+            self._index_product(old_product)
+
+    def _restore_product(self, product, seq, was_removed):
+        if self._lazy:
+            # a product of the file goes back to its position in the file, which is its seq
+            self.products.restore(product.id, product)
+            if self.products.position(product.id) is None:
+                self._product_seq[product.id] = seq
+        else:
+            self.products[product.id] = product
+            self._product_seq[product.id] = seq
+        self._index_product(product)
+
+        if not was_removed:
+            self._removed_products.discard(product.id)
+
+    def _undo_order(self, order_id):
+        self._unindex_order(self.orders.pop(order_id))
+
+    def _restore_order(self, order):
+        product = self.products[order.product_id]
+        self._change_stock(product, -order.quantity)
+        self.orders[order.id] = order
+        self._index_order(order, product.supplier_id)
+
+    def _restore_prices(self, products, prices):
+        if self._columns is not None:
+            for product, price in zip(products, prices):
+                self._columns.set_price(product.id, price)
+        self._set_prices(products, prices)
+
+    def _undo_restock(self, products, quantity):
+        for product in products:
+            self._change_stock(product, -quantity)
+
+    def supplier_revenue(self, supplier_id):
+        """
+        Total price of the orders of a supplier's products.
+
+        Args:
+            supplier_id (int): Supplier ID.
+
+        Returns:
+            float: The revenue, 0 if the supplier has no orders.
+        """
+        return self._supplier_revenue.get(supplier_id, 0)
+
+    def product_units(self, product_id):
+        """
+        Total quantity ordered of a product.
+
+        Args:
+            product_id (int): Product ID.
+
+        Returns:
+            int: The ordered units, 0 if the product has no orders.
+        """
+        return self._product_units.get(product_id, 0)
+
+    def customer_spend(self, customer_id):
+        """
+        Total price of a customer's orders.
+
+        Args:
+            customer_id (int): Customer ID.
+
+        Returns:
+            float: The spend, 0 if the customer has no orders.
+        """
+        return self._customer_spend.get(customer_id, 0)
+
+    def top_suppliers(self, n):
+        """
+        Suppliers with the highest revenue.
+
+        Args:
+            n (int): Number of suppliers.
+
+        Returns:
+            list[tuple]: Up to n (supplier id, revenue) pairs, by descending revenue.
+        """
+        return heapq.nlargest(n, self._supplier_revenue.items(), key=operator.itemgetter(1))
+
+    def top_products(self, n):
+        """
+        Products with the most ordered units.
+
+        Args:
+            n (int): Number of products.
+
+        Returns:
+            list[tuple]: Up to n (product id, units) pairs, by descending units.
+        """
+        return heapq.nlargest(n, self._product_units.items(), key=operator.itemgetter(1))
+
+    def top_customers(self, n):
+        """
+        Customers with the highest spend.
+
+        Args:
+            n (int): Number of customers.
+
+        Returns:
+            list[tuple]: Up to n (customer id, spend) pairs, by descending spend.
+        """
+        return heapq.nlargest(n, self._customer_spend.items(), key=operator.itemgetter(1))
+
+    def orders_per_city(self):
+        """
+        Number of orders of every origin city, as grouped by export_orders.
+
+        Returns:
+            dict: dictionary(city,number of orders). Orders of suppliers that are not registered are
+                not counted.
+        """
+        counts = {}
+        for supplier_id, supplier_orders in self._supplier_orders.items():
+            supplier = self.suppliers.get(supplier_id)
+            if supplier is not None:
+                counts[supplier.city] = counts.get(supplier.city, 0) + len(supplier_orders)
+        return counts
+
+    def search_products(self, query, max_price = default_query_max_price):
+        """
+        Search products by query in the product name, and optionally filter by max_price.
+
+        Args:
+            query (str): Product name or part of product name.
+            max_price (float, optional): If provided, only return products with price <= max_price.
+
+        Returns:
+            list[Product]:
+                - Products that match the query and have quantity != 0,
+                - Sorted by ascending price.
+                - If no matching products exist, return an empty list.
+        """
+        # TODO implement this method as instructed
+        if not self._search_cache_size:
+            return list(self.iter_search_products(query, max_price))
+
+        key = (query, max_price)
+        result, version = self._cached_search(key)
+        if result is None:
+            result = tuple(self.iter_search_products(query, max_price))
+            self._cache_search(key, result, version)
+        return list(result)
+
+    def _cached_search(self, key):
+        """
+        Look up a search in the search cache, counting the hit or miss.
+
+        Returns:
+            tuple: (cached result or None, search version the result must be cached with)
+        """
+        result = self._search_cache.get(key)
+        if result is None:
+            self._search_misses += 1
+        else:
+            self._search_hits += 1
+            self._search_cache.move_to_end(key)
+        return result, self._search_version
+
+    def _cache_search(self, key, result, version):
+        """
+        Keep the result of a search, unless a product it may depend on changed since version.
+        """
+        if version != self._search_version:
+            return
+
+        cache = self._search_cache
+        cache[key] = result
+        if len(cache) > self._search_cache_size:
+            cache.popitem(last=False)
+
+    def _invalidate_searches(self, product):
+        """
+        Drop the cached searches whose result may include a product, before or after it changes.
+
+        Args:
+            product: A Product that is added, replaced, removed, or whose stock drops to or rises
+                from 0.
+        """
+        self._search_version += 1
+        cache = self._search_cache
+        if not cache:
+            return
+
+        name = product.name
+        price = product.price
+        stale = [key for key in cache if key[0] in name and (key[1] is None or price <= key[1])]
+        for key in stale:
+            del cache[key]
+
+    def search_cache_info(self):
+        """
+        Report the use of the search_products cache.
+
+        Returns:
+            SearchCacheInfo: Named tuple of (hits, misses, maxsize, currsize), as functools.lru_cache reports.
+        """
+        return SearchCacheInfo(self._search_hits, self._search_misses, self._search_cache_size,
+                               len(self._search_cache))
+
+    def iter_search_products(self, query, max_price=default_query_max_price, limit=None, offset=0):
+        """
+        Lazily search products, yielding the matches of search_products in the same order.
+
+        Args:
+            query (str): Product name or part of product name.
+            max_price (float, optional): If provided, only return products with price <= max_price.
+            limit (int, optional): Maximal number of products to return. Defaults to all of them.
+            offset (int, optional): Number of cheapest matches to skip. Defaults to 0.
+
+        Returns:
+            Iterator[Product]: The matches of search_products(query, max_price)[offset:offset + limit].
+
+        Raises:
+            ValueError: If limit or offset is negative.
+
+        Notes:
+            - The system must not be modified while the iterator is consumed.
+        """
+        if limit is not None and limit < 0 or offset < 0:
+            raise ValueError("limit and offset must be non negative")
+
+        self._load_lazy_products()
+        stop = None if limit is None else offset + limit
+        bound = self._price_bound(max_price)
+        candidates = self._name_candidates(query)
+
+        # walking the price list until a page of stop matches is found visits about
+        # stop * bound / len(candidates) entries, which may be fewer than the candidates
+        if candidates is not None and len(candidates) < bound and (
+                stop is None or stop * bound > len(candidates) ** 2):
+            # few products contain the query - order just them instead of walking the price list
+            products = self.products
+            product_seq = self._product_seq
+            matches = []  # (price, product seq, product) of the matching products
+            for product_id in candidates:
+                product = products.get(product_id)
+                if product is not None and product.quantity > 0 and query in product.name and (
+                        max_price is None or product.price <= max_price):
+                    seq = product_seq.get(product_id)
+                    if seq is not None:
+                        matches.append((product.price, seq, product))
+
+            if stop is None:
+                matches.sort()
+            else:
+                matches = heapq.nsmallest(stop, matches)
+            return (product for _, _, product in itertools.islice(matches, offset, stop))
+
+        if candidates is None and stop is None and self._columns is not None and self._columns.vectorized:
+            # every match is needed and the name index can't narrow them down - filter the price and
+            # stock with vectorized masks, and check the names of what is left
+            products = self.products
+            matches = (products.get(product_id) for product_id in self._columns.in_stock_by_price(max_price))
+            return itertools.islice((product for product in matches
+                                     if product is not None and query in product.name), offset, None)
+
+        # walk the products in price order up to max_price, so the results are already sorted
+        # (products with the same price keep the order in which they were added to the system)
+        entries = self._price_entries(max_price)
+        return itertools.islice(self._walk_by_price(query, entries, candidates), offset, stop)
+
+    def _price_bound(self, max_price):
+        """
+        Number of entries of the price list with a price up to max_price.
+        """
+        by_price = self._products_by_price
+        return len(by_price) if max_price is None else bisect_right(by_price, (max_price, float("inf")))
+
+    def _price_entries(self, max_price):
+        """
+        The entries of the price list with a price up to max_price, in price order.
+        """
+        return itertools.islice(self._products_by_price, self._price_bound(max_price))
+
+    def _walk_by_price(self, query, entries, candidates):
+        products = self.products
+        for _, _, product_id in entries:
+            if candidates is not None and product_id not in candidates:
+                continue
+
+            # (a product may be removed by another thread while a concurrent system is searched)
+            product = products.get(product_id)
+            if product is not None and product.quantity > 0 and query in product.name:
+                yield product
+
+    def _name_candidates(self, query):
+        """
+        Narrow down the products whose name may contain the query, using the name index.
+
+        Args:
+            query (str): The searched substring.
+
+        Returns:
+            set[int] | None: IDs of the products containing every trigram of the query,
+                or None if the query is too short to use the index.
+        """
+        if len(query) < name_gram_size:
+            return None
+
+        sets = []
+        for gram in _name_grams(query):
+            ids = self._name_index.get(gram)
+            if ids is None:
+                return set()
+            sets.append(ids)
+
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def export_system_to_file(self, path):
+        """
+        Export system state (customers, suppliers, products) to a text file.
+
+        Args:
+            path (str): Output file path.
+
+        Behavior:
+            - Write each object on its own line, using the object's print/str representation.
+            - Orders must NOT be included.
+            - No constraint on the ordering of objects in the output.
+
+        Raises:
+            OSError (or any file-open exception): Must be propagated to the caller.
+        """
+        # TODO implement this method as instructed
+        try:
+            with open(path, 'w') as file:
+                for customer in self.customers.values():
+                    file.write(f"{customer}\n")
+
+                for supplier in self.suppliers.values():
+                    file.write(f"{supplier}\n")
+
+                for product in self.products.values():
+                    file.write(f"{product}\n")
+        except Exception as e:
+            raise e
+
+        # the next delta is relative to this file
+        self.track_changes()
+
+    def track_changes(self):
+        """
+        Start tracking the changed customers, suppliers and products, as export_system_to_file does,
+        e.g. right after the system was loaded from a file that deltas will be relative to.
+        """
+        self._dirty = set()
+        self._removed_products = set()
+
+    def export_system_delta(self, path):
+        """
+        Export only the customers, suppliers and products that changed since the last export of the
+        system (by export_system_to_file or export_system_delta) or since track_changes.
+
+        Args:
+            path (str): Output file path.
+
+        Behavior:
+            - A changed object is written as export_system_to_file writes it.
+            - A removed object is written as a line like Removed(type='Product', id=5), which
+              load_system_from_file ignores. A product that was removed and added again is written
+              as removed and then as changed.
+            - Deltas are merged with the system file they are relative to by compact_system_files.
+            - If changes are not tracked yet, the whole system is exported, and tracked from then on.
+
+        Raises:
+            OSError (or any file-open exception): Propagated to the caller. The changes stay tracked, so
+                the next delta includes them.
+        """
+        if self._dirty is None:
+            self.export_system_to_file(path)
+            return
+
+        objects = {"Customer": self.customers, "Supplier": self.suppliers, "Product": self.products}
+        changed = {"Customer": [], "Supplier": [], "Product": []}
+        removed = []
+        for class_name, id in self._dirty:
+            obj = objects[class_name].get(id)
+            if obj is None:
+                removed.append((class_name, id))
+            else:
+                changed[class_name].append(obj)
+        # new products are written in the order they were added, which orders products of the same price
+        changed["Product"].sort(key=lambda product: self._seq(product.id))
+
+        with open(path, 'w') as file:
+            for class_name, id in removed:
+                file.write(f"Removed(type='{class_name}', id={id})\n")
+
+            for class_objects in changed.values():
+                for obj in class_objects:
+                    if type(obj) is Product and obj.id in self._removed_products:
+                        # a product added again goes to the end, after the products added before it
+                        file.write(f"Removed(type='Product', id={obj.id})\n")
+                    file.write(f"{obj}\n")
+
+        self.track_changes()
+
+    def export_system_snapshot(self, path):
+        """
+        Export the whole system state (customers, suppliers, products, orders and the next order ID)
+        to a binary snapshot file, which load_system_from_file loads without parsing text.
+
+        Args:
+            path (str): Output file path.
+
+        Behavior:
+            - The file starts with a header holding the format version and the object counts.
+            - Names, cities and addresses are written once to a string table and referenced by index.
+            - Every numeric field is written as a fixed-width column.
+
+        Raises:
+            OSError (or any file-open exception): Must be propagated to the caller.
+            OverflowError: If a number doesn't fit in 64 bits.
+        """
+        strings = {}  # dictionary(string,index in the string table)
+
+        def string_column(values):
+            return [strings.setdefault(value, len(strings)) for value in values]
+
+        customers = list(self.customers.values())
+        suppliers = list(self.suppliers.values())
+        products = list(self.products.values())
+        orders = list(self.orders.values())
+
+        columns = []
+        for entities in customers, suppliers:
+            columns += [
+                ("q", [entity.id for entity in entities]),
+                ("I", string_column(entity.name for entity in entities)),
+                ("I", string_column(entity.city for entity in entities)),
+                ("I", string_column(entity.address for entity in entities)),
+            ]
+        columns += [
+            ("q", [product.id for product in products]),
+            ("I", string_column(product.name for product in products)),
+            ("d", [product.price for product in products]),
+            ("B", [isinstance(product.price, int) for product in products]),
+            ("q", [product.supplier_id for product in products]),
+            ("q", [product.quantity for product in products]),
+            ("q", [order.id for order in orders]),
+            ("q", [order.customer_id for order in orders]),
+            ("q", [order.product_id for order in orders]),
+            ("q", [order.quantity for order in orders]),
+            ("d", [order.total_price for order in orders]),
+            ("B", [isinstance(order.total_price, int) for order in orders]),
+        ]
+
+        # the string table is stored as one UTF-8 blob and the (character) offsets of its strings
+        string_offsets = [0]
+        string_offsets += itertools.accumulate(len(string) for string in strings)
+        blob = "".join(strings).encode()
+
+        with open(path, 'wb') as file:
+            file.write(_snapshot_header.pack(snapshot_magic, snapshot_version, len(strings), len(blob),
+                                             len(customers), len(suppliers), len(products), len(orders),
+                                             self.next_id))
+            _write_column(file, "Q", string_offsets)
+            file.write(blob)
+            file.write(bytes(-len(blob) % 8))
+            for typecode, values in columns:
+                _write_column(file, typecode, values)
+
+    def export_orders(self, out_file):
+        """
+        Export orders in JSON format grouped by origin city.
+
+        Args:
+            out_file (file-like)
+
+        Behavior (per specification):
+            - Produce a JSON object where:
+                - Keys: origin city (supplier city) for each order.
+                - Values: list of strings representing orders (format as specified in section 4.1.4).
+            - Order lists can be in any order.
+            - No requirement on key ordering.
+
+        Raises:
+            Any exception during writing: Must be propagated to the caller.
+
+        Notes:
+            - The order origin city is the supplier city of the ordered product.
+            - Orders of a supplier that is not registered in the system are not exported.
+        """
+        # TODO implement this method as instructed
+        _write_orders_json(out_file, self._orders_by_city())
+
+    def export_orders_ndjson(self, out_file):
+        """
+        Export orders as newline delimited JSON, one order per line tagged with its origin city.
+
+        Args:
+            out_file (file-like)
+
+        Behavior:
+            - Each line is a JSON object like {"city": "Haifa", "order": "Order(id=1, ...)"}.
+            - Orders of the same city are written one after the other, in the order of export_orders.
+
+        Raises:
+            Any exception during writing: Propagated to the caller.
+        """
+        _write_orders_ndjson(out_file, self._orders_by_city())
+
+    def _orders_by_city(self):
+        """
+        Group the orders by their origin city, without formatting them yet.
+
+        Returns:
+            dict: dictionary(city,list of iterables of order strings), one iterable per supplier.
+        """
+        orders_by_city = {}
+        for supplier_id, order_strings in self._supplier_orders.items():
+            supplier = self.suppliers.get(supplier_id)
+            if supplier is None:
+                continue
+
+            city_orders = orders_by_city.get(supplier.city)
+            if city_orders is None:
+                city_orders = orders_by_city[supplier.city] = []
+            city_orders.append(self._order_strings(supplier_id, order_strings))
+
+        return orders_by_city
+
+    def _order_strings(self, supplier_id, order_strings):
+        """
+        Get the formatted orders of a supplier, formatting (and caching) the ones that are new.
+
+        Args:
+            supplier_id (int): The supplier ID.
+            order_strings (dict): The supplier's dictionary(order id,order string or None).
+
+        Returns:
+            Iterable[str]: The supplier's orders, as printed.
+        """
+        if not self._cache_order_strings:
+            return (f"{self.orders[order_id]}" for order_id in order_strings)
+
+        if supplier_id in self._unformatted_suppliers:
+            for order_id, order_string in order_strings.items():
+                if order_string is None:
+                    order_strings[order_id] = f"{self.orders[order_id]}"
+            self._unformatted_suppliers.discard(supplier_id)
+
+        return order_strings.values()
+
+    # methods timed by enable_metrics, with the function measuring the size of their result
+    _measured_methods = {
+        "place_order": None,
+        "search_products": len,
+        "remove_object": None,
+        "export_orders": None,
+        "export_orders_ndjson": None,
+    }
+
+    def enable_metrics(self, metrics=None):
+        """
+        Start recording the calls of place_order, search_products, remove_object and the order exports.
+
+        The methods are replaced on this instance by timed wrappers, so a system whose metrics are not
+        enabled runs the original methods without any overhead.
+
+        Args:
+            metrics (Metrics, optional): Where the calls are recorded. Defaults to a new Metrics.
+
+        Returns:
+            Metrics: The metrics the calls are recorded in.
+        """
+        self.disable_metrics()
+        self.metrics = Metrics() if metrics is None else metrics
+        for name, size in self._measured_methods.items():
+            setattr(self, name, self.metrics.wrap(name, getattr(self, name), size))
+        return self.metrics
+
+    def disable_metrics(self):
+        """
+        Stop recording calls, restoring the original methods.
+        """
+        if self.metrics is not None:
+            for name in self._measured_methods:
+                del self.__dict__[name]
+            self.metrics = None
+
+
+class ConcurrentMatamazonSystem(MatamazonSystem):
+    """
+    A MatamazonSystem that may be used by many threads at once.
+
+    Locking:
+        - Stock is checked and taken under a lock striped by product ID, so orders of different
+          products don't wait for each other's stock checks, and a product can't be oversold.
+        - Order IDs are allocated, and every index is updated, under a single system lock, which
+          is always taken after the product lock.
+        - Searches hold the system lock only briefly: to look up and fill the search cache (where it
+          is also invalidated), and to copy what they read of the indexes - the name index
+          candidates and the part of the price list they walk, since a replaced product is briefly
+          missing from the indexes, and entries inserted into or deleted from the price list while it
+          is iterated would make the walk skip or repeat products. The matches are then checked
+          without the lock.
+        - Exports, and checkpoints of a journal, take every product lock and then the system lock, so
+          they see a consistent state: no order has its stock taken without being stored yet. The analytics queries, which only
+          iterate over the aggregates, take just the system lock.
+        - A transaction holds every product lock and the system lock until it commits or rolls back,
+          so other threads wait for it instead of seeing its changes.
+        - An automatic checkpoint of a journal (see Journal.checkpoint_records) is taken when the call
+          that wrote the record releases its locks, since it holds the system lock while recording,
+          and taking the product locks after it could deadlock.
+    """
+
+    def __init__(self, compact_orders=False, lock_stripes=64, search_cache_size=default_search_cache_size):
+        """
+        Initialize an empty concurrent Matamazon system.
+
+        Args:
+            compact_orders (bool, optional): See MatamazonSystem.
+            lock_stripes (int, optional): Number of product locks. Defaults to 64.
+            search_cache_size (int, optional): See MatamazonSystem.
+        """
+        super().__init__(compact_orders, search_cache_size)
+        self._lock = threading.RLock()
+        # reentrant, so the thread of a transaction, which holds all of them, may take them again
+        self._stripes = [threading.RLock() for _ in range(lock_stripes)]
+        self._checkpoint_pending = False  # set by _checkpoint_due, under the system lock
+
+    def _product_lock(self, product_id):
+        return self._stripes[hash(product_id) % len(self._stripes)]
+
+    @contextmanager
+    def _all_locks(self):
+        with ExitStack() as stack:
+            for stripe in self._stripes:
+                stack.enter_context(stripe)
+            with self._lock:
+                yield
+
+    def _checkpoint_due(self):
+        self._checkpoint_pending = True
+
+    def _take_pending_checkpoint(self):
+        """
+        Take the checkpoint requested by _checkpoint_due, once the calling thread released its locks.
+        """
+        if self._checkpoint_pending:
+            with self._all_locks():
+                # (not within a transaction, whose records are written when it commits)
+                if self._checkpoint_pending and self._undo is None and self.journal is not None:
+                    self._checkpoint_pending = False
+                    self.journal.checkpoint()
+
+    def register_entity(self, entity, is_customer):
+        with self._lock:
+            super().register_entity(entity, is_customer)
+        self._take_pending_checkpoint()
+
+    def add_or_update_product(self, product):
+        with self._product_lock(product.id), self._lock:
+            super().add_or_update_product(product)
+        self._take_pending_checkpoint()
+
+    def upsert_products(self, products):
+        with self._all_locks():
+            results = super().upsert_products(products)
+        self._take_pending_checkpoint()
+        return results
+
+    def reprice(self, supplier_id, factor):
+        with self._all_locks():
+            result = super().reprice(supplier_id, factor)
+        self._take_pending_checkpoint()
+        return result
+
+    def restock(self, supplier_id, quantity):
+        with self._all_locks():
+            result = super().restock(supplier_id, quantity)
+        self._take_pending_checkpoint()
+        return result
+
+    @contextmanager
+    def transaction(self):
+        with self._all_locks():
+            with super().transaction():
+                yield self
+        self._take_pending_checkpoint()
+
+    def place_order(self, customer_id, product_id, quantity = default_order_quantity):
+        with self._product_lock(product_id):
+            product, message = self._take_stock(product_id, quantity)
+            if product is not None:
+                with self._lock:
+                    self._add_order(customer_id, product, quantity)
+        self._take_pending_checkpoint()
+        return message
+
+    def remove_object(self, _id, class_type):
+        class_type_clean = class_type.strip().lower()
+        if class_type_clean == "order":
+            # the stock of the order's product is restored
+            order = self.orders.get(_id)
+            product_id = None if order is None else order.product_id
+            lock = self._product_lock(product_id)
+        elif class_type_clean == "product":
+            lock = self._product_lock(_id)
+        else:
+            lock = nullcontext()  # only the system lock
+
+        with lock, self._lock:
+            result = super().remove_object(_id, class_type)
+        self._take_pending_checkpoint()
+        return result
+
+    def top_suppliers(self, n):
+        with self._lock:
+            return super().top_suppliers(n)
+
+    def top_products(self, n):
+        with self._lock:
+            return super().top_products(n)
+
+    def top_customers(self, n):
+        with self._lock:
+            return super().top_customers(n)
+
+    def orders_per_city(self):
+        with self._lock:
+            return super().orders_per_city()
+
+    def _name_candidates(self, query):
+        with self._lock:
+            return super()._name_candidates(query)
+
+    def _price_entries(self, max_price):
+        # a copy, taken while no writer changes the list
+        with self._lock:
+            return self._products_by_price[:self._price_bound(max_price)]
+
+    def _cached_search(self, key):
+        with self._lock:
+            return super()._cached_search(key)
+
+    def _cache_search(self, key, result, version):
+        with self._lock:
+            super()._cache_search(key, result, version)
+
+    def export_system_to_file(self, path):
+        with self._all_locks():
+            super().export_system_to_file(path)
+
+    def export_system_delta(self, path):
+        with self._all_locks():
+            super().export_system_delta(path)
+
+    def export_system_snapshot(self, path):
+        with self._all_locks():
+            super().export_system_snapshot(path)
+
+    def export_orders(self, out_file):
+        with self._all_locks():
+            super().export_orders(out_file)
+
+    def export_orders_ndjson(self, out_file):
+        with self._all_locks():
+            super().export_orders_ndjson(out_file)
+
+
+class AsyncMatamazonSystem:
+    """
+    asyncio front-end of a MatamazonSystem.
+
+    Orders of concurrent requests are queued and applied in micro-batches by a single writer task,
+    so the system is only mutated from one place and a burst of requests costs one wake-up of the
+    writer instead of one per request. Exports run in a worker thread, while the writer waits, so
+    they don't stall the event loop.
+
+    Example:
+        async with AsyncMatamazonSystem(system) as shop:
+            message = await shop.place_order(42, 101, 2)
+    """
+
+    def __init__(self, system=None, batch_size=None):
+        """
+        Args:
+            system (MatamazonSystem, optional): The wrapped system. Defaults to a new empty system.
+            batch_size (int, optional): Largest number of orders applied together.
+                Defaults to async_batch_size.
+        """
+        self.system = MatamazonSystem() if system is None else system
+        self.batch_size = async_batch_size if batch_size is None else batch_size
+        self._queue = None
+        self._writer = None
+        self._lock = None  # held while the system is changed or exported
+
+    async def __aenter__(self):
+        self._start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _start(self):
+        if self._writer is None:
+            self._queue = asyncio.Queue()
+            self._lock = asyncio.Lock()
+            self._writer = asyncio.get_running_loop().create_task(self._write())
+
+    async def close(self):
+        """
+        Apply the orders that were already requested and stop the writer task.
+        """
+        if self._writer is not None:
+            await self._queue.join()
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+
+    async def place_order(self, customer_id, product_id, quantity = default_order_quantity):
+        """
+        Place an order, as by MatamazonSystem.place_order.
+
+        Returns:
+            str: The status message of the order.
+        """
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(((customer_id, product_id, quantity), future))
+        return await future
+
+    async def search_products(self, query, max_price = default_query_max_price):
+        """
+        Search products, as by MatamazonSystem.search_products. Orders that were requested but not
+        applied yet are not taken into account.
+        """
+        return self.system.search_products(query, max_price)
+
+    async def export_orders(self, out_file):
+        """
+        Export the orders, as by MatamazonSystem.export_orders, in a worker thread.
+        """
+        self._start()
+        async with self._lock:
+            await asyncio.to_thread(self.system.export_orders, out_file)
+
+    async def _write(self):
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            async with self._lock:
+                place_order = self.system.place_order
+                for args, future in batch:
+                    if future.cancelled():
+                        continue
+                    try:
+                        future.set_result(place_order(*args))
+                    except Exception as e:
+                        future.set_exception(e)
+
+            for _ in batch:
+                queue.task_done()
+
+
+class _Shard(MatamazonSystem):
+    """
+    The MatamazonSystem of a shard of a ShardedMatamazonSystem, running in a worker process.
+
+    Adds the operations the facade needs on top of the ones of MatamazonSystem: orders are placed with
+    IDs given by the facade, and results are returned in forms that can be sent back to it.
+    """
+
+    def __init__(self, compact_orders=False):
+        super().__init__(compact_orders)
+        self._taken = []  # (customer id, product, quantity) of the orders accepted by take_stock
+
+    def place_order_as(self, order_id, customer_id, product_id, quantity):
+        """Place an order, giving it order_id if it is accepted."""
+        self.next_id = order_id
+        return self.place_order(customer_id, product_id, quantity)
+
+    def take_stock(self, orders):
+        """
+        First phase of ShardedMatamazonSystem.place_orders: take the stock of accepted orders.
+
+        Args:
+            orders: A list of (customer_id, product_id, quantity) tuples.
+
+        Returns:
+            list[str]: The status message of every order.
+
+        Raises:
+            Exception: Whatever taking the stock of an order raised, after the stock taken for the
+                orders before it was given back.
+        """
+        # left over only if the second phase of an earlier batch never came
+        self.return_taken_stock()
+
+        messages = []
+        try:
+            for customer_id, product_id, quantity in orders:
+                product, message = self._take_stock(product_id, quantity)
+                if product is not None:
+                    self._taken.append((customer_id, product, quantity))
+                messages.append(message)
+        except BaseException:
+            self.return_taken_stock()
+            raise
+        return messages
+
+    def return_taken_stock(self):
+        """
+        Undo take_stock: give back the stock of the orders it accepted, which won't be stored.
+        """
+        for _, product, quantity in reversed(self._taken):
+            product.quantity += quantity
+            if self._columns is not None:
+                self._columns.set_quantity(product.id, product.quantity)
+        self._taken.clear()
+
+    def add_taken_orders(self, order_ids):
+        """
+        Second phase of ShardedMatamazonSystem.place_orders: store the orders accepted by take_stock.
+
+        Args:
+            order_ids: The IDs of the accepted orders, in their order.
+        """
+        for order_id, (customer_id, product, quantity) in zip(order_ids, self._taken):
+            self.next_id = order_id
+            self._add_order(customer_id, product, quantity)
+        self._taken.clear()
+
+    def remove_order(self, order_id):
+        """Remove an order that is in the system, returning its (quantity, customer id)."""
+        customer_id = self.orders[order_id].customer_id
+        return self.remove_object(order_id, "Order"), customer_id
+
+    def search_page(self, query, max_price, stop):
+        return list(self.iter_search_products(query, max_price, stop))
+
+    def order_strings_by_city(self):
+        return {city: [string for order_strings in city_orders for string in order_strings]
+                for city, city_orders in self._orders_by_city().items()}
+
+    def product_strings(self):
+        return [f"{product}" for product in self.products.values()]
+
+    def customer_spends(self):
+        return self._customer_spend
+
+
+def _run_shard(connection, compact_orders):
+    """
+    Serve the requests of a ShardedMatamazonSystem in a worker process, until None is received.
+
+    A request is a (method name, arguments) pair, answered by (True, result) or (False, exception).
+    """
+    shard = _Shard(compact_orders)
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+
+        name, args = request
+        try:
+            result = getattr(shard, name)(*args)
+        except Exception as e:
+            connection.send((False, e))
+        else:
+            connection.send((True, result))
+
+    connection.close()
+
+
+class ShardedMatamazonSystem:
+    """
+    A Matamazon system partitioned by supplier across worker processes.
+
+    Every supplier, with its products and their orders, lives in one shard: a MatamazonSystem run by a
+    worker process, picked by the supplier ID. The facade keeps what must be checked globally - the
+    customers and suppliers (so IDs stay unique), the supplier of every product, the shard of every
+    order, the number of orders of every customer, and the order ID sequence - and routes every
+    operation to its shard.
+    Searches and exports ask all the shards at once and merge their answers.
+
+    Notes:
+        - Batches (place_orders, upsert_products) are run by all the shards in parallel, while single
+          operations wait for their shard.
+        - Products returned by searches are copies of the products of the shards.
+        - The facade must be used by one thread at a time, and closed (or used as a context manager)
+          to stop the worker processes.
+    """
+
+    def __init__(self, shards=None, compact_orders=False):
+        """
+        Start the worker processes of an empty sharded system.
+
+        Args:
+            shards (int, optional): Number of worker processes. Defaults to the number of CPUs.
+            compact_orders (bool, optional): See MatamazonSystem.
+        """
+        shards = (os.cpu_count() or 1) if shards is None else shards
+        self.customers = {}  # dictionary(id,costumer)
+        self.suppliers = {}  # dictionary(id,supplier)
+        self.next_id = 1
+
+        self._customer_orders = {}  # dictionary(customer id,number of orders)
+        self._product_suppliers = {}  # dictionary(product id,supplier id)
+        self._order_shards = {}  # dictionary(order id,shard index)
+        # position of every product in the whole system, which orders products of the same price
+        self._product_seq = {}  # dictionary(product id,product seq)
+        self._next_product_seq = 0
+
+        self._connections = []
+        self._processes = []
+        for _ in range(shards):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_run_shard, args=(worker_connection, compact_orders),
+                                              daemon=True)
+            process.start()
+            worker_connection.close()
+            self._connections.append(connection)
+            self._processes.append(process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Stop the worker processes. The system can't be used afterwards.
+        """
+        for connection in self._connections:
+            connection.send(None)
+            connection.close()
+        for process in self._processes:
+            process.join()
+        self._connections = []
+        self._processes = []
+
+    def _supplier_shard(self, supplier_id):
+        return hash(supplier_id) % len(self._connections)
+
+    @staticmethod
+    def _receive(connection):
+        ok, result = connection.recv()
+        if not ok:
+            raise result
+        return result
+
+    def _call(self, shard, name, *args):
+        connection = self._connections[shard]
+        connection.send((name, args))
+        return self._receive(connection)
+
+    def _scatter(self, requests):
+        """
+        Send requests to many shards at once, and wait for all of them.
+
+        Args:
+            requests (dict): dictionary(shard index,(method name, arguments)).
+
+        Returns:
+            dict: dictionary(shard index,result). If a shard raised, the exception is raised after all
+                the shards answered.
+        """
+        for shard, request in requests.items():
+            self._connections[shard].send(request)
+
+        results = {}
+        error = None
+        for shard in requests:
+            ok, result = self._connections[shard].recv()
+            if ok:
+                results[shard] = result
+            elif error is None:
+                error = result
+
+        if error is not None:
+            raise error
+        return results
+
+    def _scatter_all(self, name, *args):
+        results = self._scatter({shard: (name, args) for shard in range(len(self._connections))})
+        return [results[shard] for shard in range(len(self._connections))]
+
+    def register_entity(self, entity, is_customer):
+        """
+        Register a Customer or Supplier, as by MatamazonSystem.register_entity.
+        """
+        check_ids(f"Customer id {entity.id} must be non negative", entity.id)
+
+        if is_customer:
+            if entity.id in self.customers:
+                raise InvalidIdException(f"Customer id {entity.id} is already taken.")
+            self.customers[entity.id] = entity
+        else:
+            if entity.id in self.suppliers:
+                raise InvalidIdException(f"Supplier id {entity.id} is already taken.")
+            self._call(self._supplier_shard(entity.id), "register_entity", entity, False)
+            self.suppliers[entity.id] = entity
+
+    def register_many(self, entities):
+        """
+        Register many customers and suppliers, as by MatamazonSystem.register_many.
+        """
+        results = []
+        for entity, is_customer in entities:
+            try:
+                self.register_entity(entity, is_customer)
+            except InvalidIdException as e:
+                results.append(e)
+            else:
+                results.append(None)
+
+        return results
+
+    def _product_shard(self, product, batch_suppliers=None):
+        """
+        Check a product as MatamazonSystem.add_or_update_product does, and find its shard.
+
+        Args:
+            product: A Product object.
+            batch_suppliers (dict, optional): dictionary(product id,supplier id) of the products checked
+                earlier in the same batch, which are not stored yet.
+        """
+        if product.supplier_id not in self.suppliers:
+            raise InvalidIdException(
+                f"Product {product} is given with supplier id {product.supplier_id} that matches no supplier.")
+
+        supplier_id = None if batch_suppliers is None else batch_suppliers.get(product.id)
+        if supplier_id is None:
+            supplier_id = self._product_suppliers.get(product.id, product.supplier_id)
+        if supplier_id != product.supplier_id:
+            raise InvalidIdException(f"Product {product} is given with un matching supplier id")
+        return self._supplier_shard(product.supplier_id)
+
+    def _shard_of_product(self, product_id):
+        supplier_id = self._product_suppliers.get(product_id)
+        return None if supplier_id is None else self._supplier_shard(supplier_id)
+
+    def _stored_product(self, product):
+        if product.id not in self._product_suppliers:
+            self._product_suppliers[product.id] = product.supplier_id
+            self._product_seq[product.id] = self._next_product_seq
+            self._next_product_seq += 1
+
+    def add_or_update_product(self, product):
+        """
+        Add a new product or update an existing product, as by MatamazonSystem.add_or_update_product.
+        """
+        shard = self._product_shard(product)
+        self._call(shard, "add_or_update_product", product)
+        self._stored_product(product)
+
+    def upsert_products(self, products):
+        """
+        Add or update many products, as by MatamazonSystem.upsert_products. The products of every shard
+        are stored by the shards in parallel.
+        """
+        results = []
+        batch_suppliers = {}  # dictionary(product id,supplier id)
+        batches = {}  # dictionary(shard index,list of (batch position, product))
+        for product in products:
+            try:
+                shard = self._product_shard(product, batch_suppliers)
+            except InvalidIdException as e:
+                results.append(e)
+                continue
+
+            batch_suppliers.setdefault(product.id, product.supplier_id)
+            batches.setdefault(shard, []).append((len(results), product))
+            results.append(None)
+
+        shard_results = self._scatter({shard: ("upsert_products", ([product for _, product in batch],))
+                                       for shard, batch in batches.items()})
+
+        stored = []  # (batch position, product) of the products the shards stored
+        for shard, batch in batches.items():
+            for (position, product), result in zip(batch, shard_results[shard]):
+                results[position] = result
+                if result is None:
+                    stored.append((position, product))
+
+        # in the order of the batch, so new products are numbered as if they were added one by one
+        stored.sort(key=operator.itemgetter(0))
+        for _, product in stored:
+            self._stored_product(product)
+        return results
+
+    def reprice(self, supplier_id, factor):
+        """
+        Multiply the prices of all the products of a supplier by a factor, as by MatamazonSystem.reprice.
+        """
+        return self._call(self._supplier_shard(supplier_id), "reprice", supplier_id, factor)
+
+    def restock(self, supplier_id, quantity):
+        """
+        Add stock to all the products of a supplier, as by MatamazonSystem.restock.
+        """
+        return self._call(self._supplier_shard(supplier_id), "restock", supplier_id, quantity)
+
+    def place_order(self, customer_id, product_id, quantity = default_order_quantity):
+        """
+        Place an order for a product by a customer, as by MatamazonSystem.place_order.
+        """
+        shard = self._shard_of_product(product_id)
+        if shard is None:
+            return "The product does not exist in the system"
+
+        message = self._call(shard, "place_order_as", self.next_id, customer_id, product_id, quantity)
+        if message == "The order has been accepted in the system":
+            self._added_order(self.next_id, customer_id, shard)
+        return message
+
+    def _added_order(self, order_id, customer_id, shard):
+        self._order_shards[order_id] = shard
+        _increment(self._customer_orders, customer_id)
+        self.next_id = order_id + 1
+
+    def place_orders(self, orders):
+        """
+        Place many orders, as by MatamazonSystem.place_orders.
+
+        The shards check and take the stock of their orders in parallel. The accepted orders are then
+        numbered in the order of the batch, as if they were placed one by one, and stored by the shards.
+        If a shard raises while taking the stock, no order of the batch is placed.
+        """
+        messages = []
+        batches = {}  # dictionary(shard index,list of (batch position, order))
+        for customer_id, product_id, *quantity in orders:
+            quantity = quantity[0] if quantity else default_order_quantity
+            shard = self._shard_of_product(product_id)
+            if shard is None:
+                messages.append("The product does not exist in the system")
+            else:
+                batches.setdefault(shard, []).append((len(messages), (customer_id, product_id, quantity)))
+                messages.append(None)
+
+        try:
+            results = self._scatter({shard: ("take_stock", ([order for _, order in batch],))
+                                     for shard, batch in batches.items()})
+        except Exception:
+            # the shards that failed gave their stock back already, so this only changes the others
+            self._scatter({shard: ("return_taken_stock", ()) for shard in batches})
+            raise
+
+        accepted = []  # (batch position, customer id, shard) of the accepted orders
+        for shard, batch in batches.items():
+            for (position, (customer_id, _, _)), message in zip(batch, results[shard]):
+                messages[position] = message
+                if message == "The order has been accepted in the system":
+                    accepted.append((position, customer_id, shard))
+
+        accepted.sort()
+        order_ids = {}  # dictionary(shard index,list of order ids)
+        for _, customer_id, shard in accepted:
+            order_ids.setdefault(shard, []).append(self.next_id)
+            self._added_order(self.next_id, customer_id, shard)
+
+        self._scatter({shard: ("add_taken_orders", (ids,)) for shard, ids in order_ids.items()})
+        return messages
+
+    def remove_object(self, _id, class_type):
+        """
+        Remove an object from the system by ID and type, as by MatamazonSystem.remove_object.
+        """
+        check_ids(f"Remove object id {_id} must be non negative", _id)
+        class_type_clean = class_type.strip().lower()
+        if class_type_clean == "order":
+            shard = self._order_shards.get(_id)
+            if shard is None:
+                return None
+
+            quantity, customer_id = self._call(shard, "remove_order", _id)
+            del self._order_shards[_id]
+            _decrement(self._customer_orders, customer_id)
+            return quantity
+
+        elif class_type_clean == "customer":
+            if _id in self._customer_orders:
+                raise InvalidIdException("Cannot remove customer - still in use in existing orders")
+            self.customers.pop(_id, None)
+
+        elif class_type_clean == "supplier":
+            # products of a supplier that was removed before may still have orders in its shard
+            self._call(self._supplier_shard(_id), "remove_object", _id, class_type)
+            self.suppliers.pop(_id, None)
+
+        elif class_type_clean == "product":
+            shard = self._shard_of_product(_id)
+            if shard is not None:
+                self._call(shard, "remove_object", _id, class_type)
+                del self._product_suppliers[_id]
+                del self._product_seq[_id]
+
+        return None
+
+    def remove_many(self, objects):
+        """
+        Remove many objects, as by MatamazonSystem.remove_many.
+        """
+        results = []
+        for _id, class_type in objects:
+            try:
+                results.append(self.remove_object(_id, class_type))
+            except InvalidIdException as e:
+                results.append(e)
+
+        return results
+
+    def search_products(self, query, max_price = default_query_max_price):
+        """
+        Search products, as by MatamazonSystem.search_products.
+        """
+        return list(self.iter_search_products(query, max_price))
+
+    def iter_search_products(self, query, max_price=default_query_max_price, limit=None, offset=0):
+        """
+        Search products, as by MatamazonSystem.iter_search_products.
+
+        Every shard finds its offset + limit cheapest matches, and the sorted answers of the shards are
+        merged by price (and by the order in which the products were added to the system).
+        """
+        if limit is not None and limit < 0 or offset < 0:
+            raise ValueError("limit and offset must be non negative")
+
+        stop = None if limit is None else offset + limit
+        pages = self._scatter_all("search_page", query, max_price, stop)
+        product_seq = self._product_seq
+        merged = heapq.merge(*pages, key=lambda product: (product.price, product_seq[product.id]))
+        return itertools.islice(merged, offset, stop)
+
+    def supplier_revenue(self, supplier_id):
+        """
+        Total price of the orders of a supplier's products, as by MatamazonSystem.supplier_revenue.
+        """
+        return self._call(self._supplier_shard(supplier_id), "supplier_revenue", supplier_id)
+
+    def product_units(self, product_id):
+        """
+        Total quantity ordered of a product, as by MatamazonSystem.product_units.
+        """
+        shard = self._shard_of_product(product_id)
+        return 0 if shard is None else self._call(shard, "product_units", product_id)
+
+    def customer_spend(self, customer_id):
+        """
+        Total price of a customer's orders in all the shards, as by MatamazonSystem.customer_spend.
+        """
+        return sum(self._scatter_all("customer_spend", customer_id))
+
+    def top_suppliers(self, n):
+        """
+        Suppliers with the highest revenue, as by MatamazonSystem.top_suppliers. Every supplier is in
+        one shard, so the top n of every shard are merged.
+        """
+        return heapq.nlargest(n, itertools.chain(*self._scatter_all("top_suppliers", n)), key=operator.itemgetter(1))
+
+    def top_products(self, n):
+        """
+        Products with the most ordered units, as by MatamazonSystem.top_products.
+        """
+        return heapq.nlargest(n, itertools.chain(*self._scatter_all("top_products", n)), key=operator.itemgetter(1))
+
+    def top_customers(self, n):
+        """
+        Customers with the highest spend, as by MatamazonSystem.top_customers. A customer may have
+        orders in every shard, so the spends of all the shards are added up first.
+        """
+        spends = {}
+        for shard_spends in self._scatter_all("customer_spends"):
+            for customer_id, spend in shard_spends.items():
+                _add_amount(spends, customer_id, spend)
+        return heapq.nlargest(n, spends.items(), key=operator.itemgetter(1))
+
+    def orders_per_city(self):
+        """
+        Number of orders of every origin city, as by MatamazonSystem.orders_per_city.
+        """
+        counts = {}
+        for shard_counts in self._scatter_all("orders_per_city"):
+            for city, count in shard_counts.items():
+                _add_amount(counts, city, count)
+        return counts
+
+    def export_system_to_file(self, path):
+        """
+        Export the customers, suppliers and products to a text file, as by
+        MatamazonSystem.export_system_to_file.
+        """
+        product_strings = self._scatter_all("product_strings")
+        with open(path, 'w') as file:
+            for customer in self.customers.values():
+                file.write(f"{customer}\n")
+
+            for supplier in self.suppliers.values():
+                file.write(f"{supplier}\n")
+
+            for strings in product_strings:
+                for string in strings:
+                    file.write(f"{string}\n")
+
+    def _orders_by_city(self):
+        orders_by_city = {}
+        for shard_orders in self._scatter_all("order_strings_by_city"):
+            for city, order_strings in shard_orders.items():
+                orders_by_city.setdefault(city, []).append(order_strings)
+        return orders_by_city
+
+    def export_orders(self, out_file):
+        """
+        Export orders in JSON format grouped by origin city, as by MatamazonSystem.export_orders.
+        """
+        _write_orders_json(out_file, self._orders_by_city())
+
+    def export_orders_ndjson(self, out_file):
+        """
+        Export orders as newline delimited JSON, as by MatamazonSystem.export_orders_ndjson.
+        """
+        _write_orders_ndjson(out_file, self._orders_by_city())
+
+
+class Metrics:
+    """
+    Call counts, latencies and result sizes of timed functions.
+
+    Every call is recorded under a name, e.g. the name of a MatamazonSystem method (see
+    MatamazonSystem.enable_metrics) or of a log command (see replay_log).
+    """
+
+    def __init__(self):
+        self._times = {}  # dictionary(name,array of call durations in seconds)
+        self._sizes = {}  # dictionary(name,array of result sizes)
+        self._lock = threading.Lock()  # calls may be recorded by many threads
+
+    def wrap(self, name, function, size=None):
+        """
+        Time a function.
+
+        Args:
+            name (str): Name the calls are recorded under.
+            function (callable): The timed function.
+            size (callable, optional): Function measuring the size of a result (e.g. len), if sizes are
+                recorded.
+
+        Returns:
+            callable: A function that calls function and records the call.
+        """
+        record = self.record
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = clock()
+            result = function(*args, **kwargs)
+            record(name, clock() - start, None if size is None else size(result))
+            return result
+
+        timed.__wrapped__ = function
+        return timed
+
+    def record(self, name, seconds, size=None):
+        """
+        Record a call.
+
+        Args:
+            name (str): Name the call is recorded under.
+            seconds (float): Duration of the call.
+            size (int, optional): Size of the call's result.
+        """
+        with self._lock:
+            times = self._times.get(name)
+            if times is None:
+                times = self._times[name] = array("d")
+            times.append(seconds)
+
+            if size is not None:
+                sizes = self._sizes.get(name)
+                if sizes is None:
+                    sizes = self._sizes[name] = array("q")
+                sizes.append(size)
+
+    def report(self):
+        """
+        Summarize the recorded calls.
+
+        Returns:
+            dict: dictionary(name,dictionary) with the count of the calls, their total, mean, median,
+                90th and 99th percentile and maximal duration in seconds, and, if result sizes were
+                recorded, the total, mean and maximal size. Can be dumped by json.dump.
+        """
+        report = {}
+        with self._lock:
+            for name, times in self._times.items():
+                ordered = sorted(times)
+                total = sum(ordered)
+                entry = report[name] = {
+                    "count": len(ordered),
+                    "total_seconds": total,
+                    "mean_seconds": total / len(ordered),
+                    "p50_seconds": _percentile(ordered, 50),
+                    "p90_seconds": _percentile(ordered, 90),
+                    "p99_seconds": _percentile(ordered, 99),
+                    "max_seconds": ordered[-1],
+                }
+
+                sizes = self._sizes.get(name)
+                if sizes:
+                    entry["size_total"] = sum(sizes)
+                    entry["size_mean"] = sum(sizes) / len(sizes)
+                    entry["size_max"] = max(sizes)
+
+        return report
+
+
+def _percentile(ordered, percent):
+    """Nearest-rank percentile of a sorted non empty sequence."""
+    return ordered[max(0, -(-len(ordered) * percent // 100) - 1)]
+
+
+def _read_chunks(read):
+    """
+    Read a file in chunks that end at a line end (except maybe the last one).
+
+    Args:
+        read: The read(size) function of the file.
+    """
+    rest = b""
+    while True:
+        chunk = read(read_chunk_size)
+        if not chunk:
+            break
+
+        end = chunk.rfind(b"\n") + 1
+        if end:
+            yield rest + chunk[:end]
+            rest = chunk[end:]
+        else:
+            rest += chunk
+
+    if rest:
+        yield rest
+
+
+def _read_file_chunks(path):
+    with open(path, 'rb') as file:
+        try:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # empty files, pipes etc. can't be mapped
+            yield from _read_chunks(file.read)
+            return
+
+        with data:
+            yield from _read_chunks(data.read)
+
+
+def read_lines(path, decode=False):
+    """
+    Read the lines of a file through large memory mapped (or buffered) chunks.
+
+    Args:
+        path (str): The file path, or "-" for the standard input.
+        decode (bool, optional): Decode the lines from UTF-8. Defaults to False.
+
+    Returns:
+        Iterator[bytes] | Iterator[str]: The lines of the file, without their line ends.
+            Lines are decoded a whole chunk at a time.
+
+    Raises:
+        OSError (or any file-open exception): Propagated to the caller.
+    """
+    if path == "-":
+        chunks = _read_chunks(sys.stdin.buffer.read)
+    else:
+        chunks = _read_file_chunks(path)
+
+    for chunk in chunks:
+        lines = chunk.decode().split("\n") if decode else chunk.split(b"\n")
+        if not lines[-1]:
+            # the chunk ends with a line end
+            lines.pop()
+        yield from lines
+
+
+def load_system_from_file(path, lazy=False):
+    """
+    Load a MatamazonSystem from an input file.
+
+    Args:
+        path (str): Path to a text file containing customers, suppliers and products.
+        lazy (bool, optional): Read the customers, suppliers and products of a text file only when they
+            are first accessed (see load_system_lazily). Defaults to False.
+
+    Returns:
+        MatamazonSystem: Initialized system with the data found in the file.
+
+    Behavior:
+        - The file lines contain objects in the format produced by export_system_to_file (section 4.2).
+        - Lines may appear in any order (e.g., product lines can appear before supplier lines).
+        - Illegal lines may be ignored.
+        - If an exception occurs during the creation of any required object due to invalid data,
+          the function should stop and propagate the exception (as specified).
+
+    Notes:
+        - Lines are parsed by parse_object_line instead of eval(), so loading an untrusted file
+          can't run code.
+        - A binary snapshot (see MatamazonSystem.export_system_snapshot) is detected by its header
+          and loaded by load_system_snapshot.
+    """
+    # TODO implement this function as instructed
+    if _is_snapshot(path):
+        return load_system_snapshot(path)
+    if lazy:
+        return load_system_lazily(path)
+
+    system = MatamazonSystem()
+    products = {}  # indexed together once the whole file was read
+    try:
+        for line in read_lines(path, decode=True):
+            line = line.strip()
+            if line.isspace():
+                continue
+
+            try:
+                val = parse_object_line(line)
+
+                if isinstance(val, Customer):
+                    system.customers[val.id] = val
+
+                elif isinstance(val, Supplier):
+                    system.suppliers[val.id] = val
+
+                elif isinstance(val, Product):
+                    products[val.id] = val
+
+
+            except (NameError, SyntaxError, TypeError):
+                continue
+
+    except Exception as e:
+        raise e
+
+    system._store_products(products.values())
+
+    return system
+
+
+_snapshot_header = struct.Struct("<8sI4x7Q")
+
+
+def _write_column(file, typecode, values):
+    column = array(typecode, values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    file.write(column)
+    file.write(bytes(-len(column) * column.itemsize % 8))
+
+
+class _SnapshotReader:
+    """
+    Reads the fixed-width columns of a binary snapshot one after the other.
+    """
+
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.offset = offset
+
+    def read(self, size):
+        end = self.offset + size
+        if end > len(self.buffer):
+            raise ValueError("The system snapshot is truncated")
+
+        data = self.buffer[self.offset:end]
+        self.offset = end + (-size % 8)
+        return data
+
+    def array(self, typecode, count):
+        column = array(typecode)
+        column.frombytes(self.read(count * column.itemsize))
+        if sys.byteorder == "big":
+            column.byteswap()
+        return column
+
+    def column(self, typecode, count):
+        return self.array(typecode, count).tolist()
+
+
+def load_system_snapshot(path):
+    """
+    Load a MatamazonSystem from a binary snapshot written by MatamazonSystem.export_system_snapshot.
+
+    Args:
+        path (str): Path to the snapshot file.
+
+    Returns:
+        MatamazonSystem: The system exactly as it was exported, including its orders and next order ID.
+
+    Raises:
+        OSError (or any file-open exception): Propagated to the caller.
+        ValueError: If the file is not a valid snapshot.
+        InvalidIdException, InvalidPriceException: If an object in the snapshot is invalid.
+    """
+    system = MatamazonSystem()
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+        if len(snapshot) < _snapshot_header.size:
+            raise ValueError("The system snapshot is truncated")
+
+        (magic, version, string_count, blob_size, customer_count, supplier_count, product_count, order_count,
+         next_id) = _snapshot_header.unpack_from(snapshot)
+        if magic != snapshot_magic or version != snapshot_version:
+            raise ValueError(f"{path} is not a version {snapshot_version} system snapshot")
+
+        reader = _SnapshotReader(snapshot, _snapshot_header.size)
+        string_offsets = reader.column("Q", string_count + 1)
+        blob = reader.read(blob_size).decode()
+        strings = [blob[start:end] for start, end in zip(string_offsets, string_offsets[1:])]
+
+        for count, entity_class, entities in ((customer_count, Customer, system.customers),
+                                              (supplier_count, Supplier, system.suppliers)):
+            ids = reader.column("q", count)
+            names, cities, addresses = (reader.column("I", count) for _ in range(3))
+            for id, name, city, address in zip(ids, names, cities, addresses):
+                entities[id] = entity_class(id, strings[name], strings[city], strings[address])
+
+        ids = reader.column("q", product_count)
+        names = reader.column("I", product_count)
+        prices = reader.column("d", product_count)
+        int_prices = reader.column("B", product_count)
+        supplier_ids = reader.column("q", product_count)
+        quantities = reader.column("q", product_count)
+        system._store_products(
+            Product(id, strings[name], int(price) if int_price else price, supplier_id, quantity)
+            for id, name, price, int_price, supplier_id, quantity
+            in zip(ids, names, prices, int_prices, supplier_ids, quantities))
+
+        ids = reader.column("q", order_count)
+        customer_ids = reader.column("q", order_count)
+        product_ids = reader.column("q", order_count)
+        quantities = reader.column("q", order_count)
+        total_prices = reader.column("d", order_count)
+        int_totals = reader.column("B", order_count)
+        for id, customer_id, product_id, quantity, total_price, int_total in zip(
+                ids, customer_ids, product_ids, quantities, total_prices, int_totals):
+            if product_id not in system.products:
+                raise ValueError(f"Order {id} in the system snapshot is of a missing product")
+
+            order = Order(id, customer_id, product_id, quantity, int(total_price) if int_total else total_price)
+            system.orders[id] = order
+            system._index_order(order, system.products[product_id].supplier_id)
+
+    system.next_id = next_id
+    return system
+
+
+_object_classes = {"Customer": Customer, "Supplier": Supplier, "Product": Product, "Order": Order}
+
+_int_literal = r"(-?(?:0|[1-9][0-9]*))"
+_number_literal = r"(-?(?:[0-9]+\.[0-9]*(?:[eE][-+]?[0-9]+)?|[0-9]+[eE][-+]?[0-9]+|0|[1-9][0-9]*))"
+_str_literal = r"'([^'\\\n]*)'"
+
+_entity_line = re.compile(
+    rf"(Customer|Supplier)\(id={_int_literal}, name={_str_literal}, city={_str_literal}, address={_str_literal}\)")
+_product_line = re.compile(
+    rf"Product\(id={_int_literal}, name={_str_literal}, price={_number_literal}, "
+    rf"supplier_id={_int_literal}, quantity={_int_literal}\)")
+
+
+def _number(literal):
+    if "." in literal or "e" in literal or "E" in literal:
+        return float(literal)
+    return int(literal)
+
+
+_product_line_bytes = re.compile(_product_line.pattern.encode())
+_entity_line_bytes = re.compile(_entity_line.pattern.encode())
+
+# magic, version, size and modification time (ns) of the indexed file, number of customers, suppliers
+# and products, followed by their columns (see LazyObjects)
+_system_index_header = struct.Struct("<8sI4xQq3Q")
+_system_index_columns = 5
+
+
+def load_system_lazily(path):
+    """
+    Load a MatamazonSystem from a text system file, reading its customers, suppliers and products only
+    when they are first accessed.
 
     Args:
         path (str): Path to a text file containing customers, suppliers and products.
 
     Returns:
-        MatamazonSystem: Initialized system with the data found in the file.
+        MatamazonSystem: A system whose customers, suppliers and products are LazyObjects.
 
     Behavior:
-        - The file lines contain objects in the format produced by export_system_to_file (section 4.2).
-        - Lines may appear in any order (e.g., product lines can appear before supplier lines).
-        - Illegal lines may be ignored.
-        - If an exception occurs during the creation of any required object due to invalid data,
-          the function should stop and propagate the exception (as specified).
+        - The file is scanned for the ID, offset and length of the line of every object, and the offsets
+          are saved next to it (path + system_index_suffix). Later loads of the unchanged file (same size
+          and modification time) read the saved offsets instead of scanning the file again.
+        - The scan validates the lines as load_system_from_file does, so it propagates the same
+          exceptions, but it creates no objects.
+        - The product indexes are built by the first search or reprice, which reads all the products.
+
+    Raises:
+        OSError (or any file-open exception): Propagated to the caller. Failing to save the offsets is
+            not an error.
 
     Notes:
-        - The assignment hints that eval() may be used.
+        - The file is memory mapped, and must not change while the system is used.
+        - Files with IDs that don't fit in 64 bits are loaded by load_system_from_file.
     """
-    # TODO implement this function as instructed
+    index = _read_system_index(path)
+    if index is None:
+        index = _index_system_file(path)
+        if index is None:
+            return load_system_from_file(path)
+
+        try:
+            _write_system_index(path, index)
+        except OSError:
+            pass  # e.g. a read-only directory - the next load scans the file again
+
+    with open(path, 'rb') as file:
+        source = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size \
+            else b""
+
     system = MatamazonSystem()
+    system.customers, system.suppliers, system.products = (LazyObjects(source, *columns) for columns in index[2])
+    # products added later come after the products of the file (see export_system_delta)
+    system._next_product_seq = len(system.products)
+    system._lazy = True
+    return system
+
+
+def _index_system_file(path):
+    """
+    Scan a system file for the ID, offset and length of the line of every customer, supplier and product.
+
+    Returns:
+        tuple | None: (file size, file modification time in ns, [columns of the customers, suppliers and
+            products, as taken by LazyObjects]), or None if an ID doesn't fit in the columns.
+
+    Raises:
+        As load_system_from_file, for lines with invalid data.
+    """
+    stat = os.stat(path)
+    # for every class: (dictionary(id,row), ids, offsets, lengths)
+    kinds = {class_name: ({}, array("q"), array("q"), array("q"))
+             for class_name in ("Customer", "Supplier", "Product")}
+    offset = 0
+    for line in read_lines(path):
+        class_name = None
+        stripped = line.strip()
+        product = _product_line_bytes.fullmatch(stripped)
+        entity = None if product else _entity_line_bytes.fullmatch(stripped)
+        if product and not any(literal.startswith(b"-") for literal in product.group(1, 3, 4)):
+            class_name, id = "Product", int(product.group(1))
+        elif entity and not entity.group(2).startswith(b"-"):
+            class_name, id = entity.group(1).decode(), int(entity.group(2))
+        else:
+            # other formats, and invalid values the parser raises for as load_system_from_file does
+            try:
+                obj = parse_object_line(line.decode().strip())
+            except (NameError, SyntaxError, TypeError):
+                obj = None
+            if isinstance(obj, (Customer, Supplier, Product)):
+                class_name, id = type(obj).__name__, obj.id
+
+        if class_name is not None:
+            rows, ids, offsets, lengths = kinds[class_name]
+            row = rows.get(id)
+            try:
+                if row is None:
+                    # an object keeps the position of its first line and the data of its last one
+                    ids.append(id)
+                    offsets.append(offset)
+                    lengths.append(len(line))
+                    rows[id] = len(ids) - 1
+                else:
+                    offsets[row] = offset
+                    lengths[row] = len(line)
+            except (OverflowError, TypeError):
+                return None
+
+        offset += len(line) + 1
+
+    columns = []
+    for rows, ids, offsets, lengths in kinds.values():
+        by_id = sorted(rows.items())
+        columns.append((ids, offsets, lengths, array("q", (id for id, _ in by_id)),
+                        array("q", (row for _, row in by_id))))
+    return stat.st_size, stat.st_mtime_ns, columns
+
+
+def _write_system_index(path, index):
+    size, mtime, columns = index
+    temporary_path = f"{path}{system_index_suffix}.tmp"
+    with open(temporary_path, 'wb') as file:
+        file.write(_system_index_header.pack(system_index_magic, system_index_version, size, mtime,
+                                             *(len(kind_columns[0]) for kind_columns in columns)))
+        for kind_columns in columns:
+            for column in kind_columns:
+                _write_column(file, "q", column)
+    os.replace(temporary_path, path + system_index_suffix)
+
+
+def _read_system_index(path):
+    """
+    Read the offsets saved next to a system file by load_system_lazily.
+
+    Returns:
+        tuple | None: The index as returned by _index_system_file, or None if no index was saved or the
+            file changed since.
+    """
     try:
-        with open(path, 'r') as file:
-            for line in file:
-                line = line.strip()
-                if line.isspace():
-                    continue
+        stat = os.stat(path)
+        with open(path + system_index_suffix, 'rb') as file:
+            data = file.read()
+    except OSError:
+        return None
 
-                try:
-                    val = eval(line, {"Customer": Customer,
-                                      "Supplier": Supplier,
-                                      "Product": Product,
-                                      "Order": Order})
+    if len(data) < _system_index_header.size:
+        return None
+    magic, version, size, mtime, *counts = _system_index_header.unpack_from(data)
+    if magic != system_index_magic or version != system_index_version or \
+            (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+        return None
+
+    reader = _SnapshotReader(data, _system_index_header.size)
+    try:
+        columns = [tuple(reader.array("q", count) for _ in range(_system_index_columns)) for count in counts]
+    except ValueError:
+        return None
+    return size, mtime, columns
 
-                    if isinstance(val, Customer):
-                        system.customers[val.id] = val
 
-                    elif isinstance(val, Supplier):
-                        system.suppliers[val.id] = val
+_removed_line = re.compile(r"Removed\(type='(Customer|Supplier|Product)', id=(-?\d+)\)")
 
-                    elif isinstance(val, Product):
-                        system.products[val.id] = val
 
+def compact_system_files(base_path, delta_paths, out_path):
+    """
+    Merge a system file with the deltas written after it into a full system file.
 
-                except (NameError, SyntaxError, TypeError):
-                    continue
+    Args:
+        base_path (str): A system file, as written by export_system_to_file (or a binary snapshot).
+        delta_paths: The delta files written by export_system_delta since the base file, oldest first.
+        out_path (str): The merged system file, loadable by load_system_from_file. May be base_path.
 
-    except Exception as e:
-        raise e
+    Behavior:
+        - An object of a delta replaces the object of the same type and ID, in its place.
+        - New objects are added at the end, so products keep the order in which they were added.
+        - Removed objects are left out, as are lines that describe no object.
+
+    Raises:
+        As load_system_from_file, for lines with invalid data.
+    """
+    records = {}  # dictionary((class name, id),object line)
+
+    if _is_snapshot(base_path):
+        system = load_system_snapshot(base_path)
+        for objects in system.customers, system.suppliers, system.products:
+            for obj in objects.values():
+                records[type(obj).__name__, obj.id] = f"{obj}"
+    else:
+        _merge_system_lines(records, base_path)
+
+    for delta_path in delta_paths:
+        _merge_system_lines(records, delta_path)
+
+    temporary_path = f"{out_path}.tmp"
+    with open(temporary_path, 'w') as file:
+        for line in records.values():
+            file.write(f"{line}\n")
+    os.replace(temporary_path, out_path)
+
+
+def _is_snapshot(path):
+    with open(path, 'rb') as file:
+        return file.read(len(snapshot_magic)) == snapshot_magic
+
+
+def _merge_system_lines(records, path):
+    for line in read_lines(path, decode=True):
+        line = line.strip()
+        if not line:
+            continue
+
+        match = _removed_line.fullmatch(line)
+        if match:
+            records.pop((match.group(1), int(match.group(2))), None)
+            continue
+
+        # lines in the exact printed format are kept as they are, without creating their objects
+        match = _product_line.fullmatch(line)
+        if match:
+            records["Product", int(match.group(1))] = line
+            continue
+
+        match = _entity_line.fullmatch(line)
+        if match:
+            records[match.group(1), int(match.group(2))] = line
+            continue
+
+        try:
+            obj = parse_object_line(line)
+        except (NameError, SyntaxError, TypeError):
+            continue
+
+        if isinstance(obj, (Customer, Supplier, Product)):
+            records[type(obj).__name__, obj.id] = f"{obj}"
+
+
+def parse_object_line(line):
+    """
+    Parse one line of a system file into the object it describes, without using eval().
+
+    Lines in the exact format printed by the classes are matched by regular expressions.
+    Any other line is parsed as a Python call expression whose arguments must all be literals.
+
+    Args:
+        line (str): A stripped line of a system file.
+
+    Returns:
+        Customer | Supplier | Product | Order | None: The described object, or None if the line
+            doesn't describe one of them.
+
+    Raises:
+        SyntaxError: If the line is not a valid Python expression.
+        TypeError: If the arguments don't fit the class constructor.
+        InvalidIdException, InvalidPriceException: If the object data is invalid.
+    """
+    match = _product_line.fullmatch(line)
+    if match:
+        id, name, price, supplier_id, quantity = match.groups()
+        return Product(int(id), name, _number(price), int(supplier_id), int(quantity))
+
+    match = _entity_line.fullmatch(line)
+    if match:
+        class_name, id, name, city, address = match.groups()
+        return _object_classes[class_name](int(id), name, city, address)
+
+    # names with quotes or escapes, positional arguments, odd spacing etc.
+    call = ast.parse(line, mode="eval").body
+    if not isinstance(call, ast.Call) or not isinstance(call.func, ast.Name):
+        return None
+
+    object_class = _object_classes.get(call.func.id)
+    if object_class is None:
+        return None
+
+    try:
+        args = [ast.literal_eval(arg) for arg in call.args]
+        kwargs = {keyword.arg: ast.literal_eval(keyword.value) for keyword in call.keywords}
+    except ValueError:
+        # not a literal (eval() would have to run code to get the value)
+        return None
+
+    if None in kwargs:
+        return None
+    return object_class(*args, **kwargs)
+
+
+_journal_suffixes = {"checkpoint": "snap", "journal": "log"}
+_journal_file_name = re.compile(r"(checkpoint|journal)-([0-9]+)\.(?:snap|log)")
+
+
+class _DeferredRecords(list):
+    """
+    Journal records of an open transaction, written to the journal when it commits (see
+    MatamazonSystem.transaction).
+    """
+
+    def record(self, *record):
+        self.append(record)
 
-    return system
+
+class Journal:
+    """
+    Write-ahead journal and checkpoints of a MatamazonSystem, kept together in a directory.
+
+    Every mutation applied to the journaled system (register_entity, add_or_update_product, a
+    successful place_order and remove_object) is appended as a JSON line to the current journal
+    file. Records are buffered and written with a single fsync every journal_sync_records records
+    or journal_sync_seconds seconds (group commit), so a crash loses at most the last group.
+
+    A checkpoint writes the system to a binary snapshot and starts a new, empty journal file.
+    Files are numbered by generation: checkpoint-<n>.snap holds the state before journal-<n>.log,
+    so recovery loads the newest checkpoint and replays only the journal that follows it.
+
+    Example:
+        journal = Journal("state")
+        system = journal.recover()
+        system.place_order(42, 101)
+        journal.checkpoint()
+        journal.close()
+    """
+
+    def __init__(self, directory, checkpoint_records=None):
+        """
+        Args:
+            directory (str): Directory of the journal and checkpoint files (created if missing).
+            checkpoint_records (int, optional): Take a checkpoint every this many records.
+                Defaults to checkpoints only by calling checkpoint().
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.checkpoint_records = checkpoint_records
+        self.system = None
+        self._generation = 0
+        self._file = None
+        self._pending = []  # records not written yet
+        self._last_sync = time.monotonic()
+        self._records = 0  # records since the last checkpoint
+
+    def _path(self, kind, generation):
+        return os.path.join(self.directory, f"{kind}-{generation}.{_journal_suffixes[kind]}")
+
+    def _generations(self, kind):
+        generations = []
+        for file_name in os.listdir(self.directory):
+            match = _journal_file_name.fullmatch(file_name)
+            if match and match[1] == kind:
+                generations.append(int(match[2]))
+        return sorted(generations)
+
+    def recover(self):
+        """
+        Load the newest checkpoint and replay the journal written after it.
+
+        Returns:
+            MatamazonSystem: The recovered system, journaled from now on.
+
+        Raises:
+            ValueError: If a journal record (other than a torn last line) can't be read.
+        """
+        checkpoints = self._generations("checkpoint")
+        self._generation = checkpoints[-1] if checkpoints else 0
+        system = load_system_snapshot(self._path("checkpoint", self._generation)) if checkpoints \
+            else MatamazonSystem()
+
+        journal_path = self._path("journal", self._generation)
+        if os.path.exists(journal_path):
+            self._replay(system, journal_path)
+
+        # files of older generations are left behind by a crash during a checkpoint
+        for kind in "checkpoint", "journal":
+            for generation in self._generations(kind):
+                if generation < self._generation:
+                    os.remove(self._path(kind, generation))
+
+        self._file = open(journal_path, 'a', encoding='utf-8')
+        self.system = system
+        system.journal = self
+        return system
+
+    @staticmethod
+    def _replay(system, path):
+        with open(path, 'rb') as file:
+            data = file.read()
+        lines = data.split(b"\n")
+
+        if lines[-1]:
+            # the last record was torn by a crash while it was written (even if only its line end is
+            # missing) - drop it, so new records don't continue its line
+            os.truncate(path, len(data) - len(lines[-1]))
+            lines.pop()
+
+        for number, line in enumerate(lines, 1):
+            if not line:
+                continue
+
+            try:
+                kind, *args = json.loads(line)
+            except ValueError:
+                raise ValueError(f"{path}:{number}: Unreadable journal record")
+
+            if kind == "register":
+                is_customer, id, name, city, address = args
+                entity_class = Customer if is_customer else Supplier
+                system.register_entity(entity_class(id, name, city, address), is_customer)
+            elif kind == "product":
+                system.add_or_update_product(Product(*args))
+            elif kind == "order":
+                system.place_order(*args)
+            elif kind == "remove":
+                system.remove_object(*args)
+            elif kind == "reprice":
+                system.reprice(*args)
+            elif kind == "restock":
+                system.restock(*args)
+            else:
+                raise ValueError(f"{path}:{number}: Unknown journal record {kind}")
+
+    def record(self, *record):
+        """
+        Append a mutation record to the journal (called by the journaled MatamazonSystem).
+        """
+        self.record_many((record,))
+
+    def record_many(self, records):
+        """
+        Append a group of mutation records to the journal, e.g. those of a committed transaction.
+
+        The records must all be applied to the system already: an automatic checkpoint (see
+        checkpoint_records) is only taken after the last of them.
+
+        Args:
+            records: An iterable of records, each a tuple of the arguments of record.
+        """
+        for record in records:
+            self._pending.append(json.dumps(record, ensure_ascii=False))
+            self._records += 1
+
+        if len(self._pending) >= journal_sync_records or \
+                time.monotonic() - self._last_sync >= journal_sync_seconds:
+            self.sync()
+
+        if self.checkpoint_records is not None and self._records >= self.checkpoint_records:
+            self.system._checkpoint_due()
+
+    def sync(self):
+        """
+        Write the buffered records and fsync the journal file.
+        """
+        if self._pending:
+            self._pending.append("")
+            self._file.write("\n".join(self._pending))
+            self._pending.clear()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
+
+    def checkpoint(self):
+        """
+        Snapshot the system and start a new journal, so recovery doesn't need to replay the old one.
+        """
+        # no record may be written between the snapshot and the new journal
+        with self.system._all_locks():
+            self.sync()
+            generation = self._generation + 1
+            path = self._path("checkpoint", generation)
+            self.system.export_system_snapshot(path + ".tmp")
+            with open(path + ".tmp", 'rb') as file:
+                os.fsync(file.fileno())
+            os.replace(path + ".tmp", path)
+
+            self._file.close()
+            self._file = open(self._path("journal", generation), 'a', encoding='utf-8')
+            for kind in "checkpoint", "journal":
+                if os.path.exists(self._path(kind, self._generation)):
+                    os.remove(self._path(kind, self._generation))
+
+            self._generation = generation
+            self._records = 0
+
+    def close(self):
+        """
+        Sync the journal, close it and detach it from the system.
+        """
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+        if self.system is not None:
+            self.system.journal = None
+            self.system = None
 
 
 wrong_arg_msg = "Usage: python3 matamazon.py -l < matamazon _log > -s < matamazon _system > -o <output_file > -os " \
@@ -536,6 +3808,279 @@ def swap_underscore(s):
     return s.replace('_', ' ')
 
 
+def _make_log_parsers(text, decode):
+    """
+    Build the per-command parsers of parse_log_line, for fields of one type (str or bytes).
+
+    Args:
+        text: Turns a name field into the name (underscores become spaces).
+        decode: Turns a keyword field into a str.
+
+    Returns:
+        dict: dictionary(command,parser of the fields of the line).
+    """
+    def parse_register(fields):
+        entity_type = decode(fields[1])
+        entity_id = int(fields[2])
+        name = text(fields[3])
+        city = text(fields[4])
+        address = text(fields[5])
+
+        if entity_type == "customer":
+            return "register", (Customer(entity_id, name, city, address), True)
+        if entity_type == "supplier":
+            return "register", (Supplier(entity_id, name, city, address), False)
+        raise ValueError(f"Unknown entity type {entity_type}")
+
+    def parse_product(fields):
+        return "product", (Product(int(fields[1]), text(fields[2]), float(fields[3]), int(fields[4]),
+                                   int(fields[5])),)
+
+    def parse_remove(fields):
+        return "remove", (int(fields[2]), decode(fields[1]))
+
+    def parse_order(fields):
+        quantity = default_order_quantity if len(fields) <= 3 else int(fields[3])
+        return "order", (int(fields[1]), int(fields[2]), quantity)
+
+    def parse_search(fields):
+        # search <query> [max_price] [limit] [offset]
+        query = text(fields[1])
+        max_price = default_query_max_price if len(fields) <= 2 else float(fields[2])
+        limit = None if len(fields) <= 3 else int(fields[3])
+        offset = 0 if len(fields) <= 4 else int(fields[4])
+        return "search", (query, max_price, limit, offset)
+
+    def parse_total(fields):
+        # revenue <supplier id> | units <product id> | spend <customer id>
+        return decode(fields[0]), (int(fields[1]),)
+
+    def parse_top(fields):
+        # top <suppliers|products|customers> <n>
+        kind = decode(fields[1])
+        if kind not in ("suppliers", "products", "customers"):
+            raise ValueError(f"Unknown top kind {kind}")
+        return "top", (kind, int(fields[2]))
+
+    def parse_cities(fields):
+        # cities
+        return "cities", ()
+
+    def parse_reprice(fields):
+        # reprice <supplier id> <factor>
+        return "reprice", (int(fields[1]), float(fields[2]))
+
+    def parse_restock(fields):
+        # restock <supplier id> <quantity>
+        return "restock", (int(fields[1]), int(fields[2]))
+
+    return {
+        "register": parse_register,
+        "add": parse_product,
+        "update": parse_product,
+        "remove": parse_remove,
+        "order": parse_order,
+        "search": parse_search,
+        "revenue": parse_total,
+        "units": parse_total,
+        "spend": parse_total,
+        "top": parse_top,
+        "cities": parse_cities,
+        "reprice": parse_reprice,
+        "restock": parse_restock,
+    }
+
+
+def _swap_underscore_bytes(s):
+    return s.replace(b'_', b' ').decode()
+
+
+# int() and float() parse bytes as well, so only names and keywords of bytes lines are decoded
+_log_parsers = _make_log_parsers(swap_underscore, str)
+_log_parsers.update((command.encode(), parser)
+                    for command, parser in _make_log_parsers(_swap_underscore_bytes, bytes.decode).items())
+
+
+def parse_log_line(line):
+    """
+    Parse a line of a Matamazon log into a command.
+
+    Args:
+        line (str | bytes): A log line, e.g. "order 42 101 3". Fields of bytes lines are split on ASCII
+            whitespace and decoded from UTF-8.
+
+    Returns:
+        tuple | None: A (handler name, arguments) command, applied by calling the log_handlers handler of
+            that name with the arguments. None for a blank line.
+
+    Raises:
+        ValueError: If the command or entity type is unknown, or a number is malformed.
+        IndexError: If the line is missing fields.
+        InvalidIdException, InvalidPriceException: If the described object is invalid.
+    """
+    fields = line.split()
+    if not fields:
+        return None
+
+    parser = _log_parsers.get(fields[0])
+    if parser is None:
+        raise ValueError(f"Unknown log command {fields[0]}")
+    return parser(fields)
+
+
+def log_handlers(system, out=None, stats=None):
+    """
+    Build the table of handlers that apply parsed log commands to a system.
+
+    Args:
+        system (MatamazonSystem): The system the commands are applied to.
+        out (file-like, optional): Where search results are printed. Defaults to sys.stdout.
+        stats (Metrics, optional): If given, every command is recorded in it under "log <handler name>".
+
+    Returns:
+        dict: dictionary(handler name,function taking the command arguments).
+    """
+    def search(query, max_price, limit, offset):
+        if limit is None:
+            results = system.search_products(query, max_price)
+        else:
+            results = list(system.iter_search_products(query, max_price, limit, offset))
+        print(results, file=sys.stdout if out is None else out)
+
+    def printed(query):
+        def handler(*args):
+            print(query(*args), file=sys.stdout if out is None else out)
+        return handler
+
+    top_queries = {
+        "suppliers": system.top_suppliers,
+        "products": system.top_products,
+        "customers": system.top_customers,
+    }
+
+    handlers = {
+        "register": system.register_entity,
+        "product": system.add_or_update_product,
+        "remove": system.remove_object,
+        "order": system.place_order,
+        "search": search,
+        "revenue": printed(system.supplier_revenue),
+        "units": printed(system.product_units),
+        "spend": printed(system.customer_spend),
+        "top": printed(lambda kind, n: top_queries[kind](n)),
+        "cities": printed(system.orders_per_city),
+        "reprice": system.reprice,
+        "restock": system.restock,
+    }
+    if stats is not None:
+        handlers = {name: stats.wrap(f"log {name}", handler) for name, handler in handlers.items()}
+    return handlers
+
+
+def replay_log(system, lines, out=None, stats=None):
+    """
+    Apply the commands of a Matamazon log to a system, in order.
+
+    Args:
+        system (MatamazonSystem): The system the commands are applied to.
+        lines: An iterable of log lines (str or bytes, e.g. an open log file or read_lines(path)).
+        out (file-like, optional): Where search results are printed. Defaults to sys.stdout.
+        stats (Metrics, optional): If given, the commands are timed in it, per command (see log_handlers).
+
+    Returns:
+        int: The number of commands applied (blank lines are not counted).
+
+    Raises:
+        Any exception raised while parsing or applying a line. The lines before it stay applied,
+        unless the log is replayed in a transaction (see MatamazonSystem.transaction).
+    """
+    handlers = log_handlers(system, out, stats)
+    parse = parse_log_line
+    count = 0
+    for line in lines:
+        command = parse(line)
+        if command is None:
+            continue
+
+        name, args = command
+        handlers[name](*args)
+        count += 1
+
+    return count
+
+
+def _parse_log_chunk(lines):
+    """
+    Parse a chunk of log lines (in a worker process).
+
+    Returns:
+        tuple: (commands, error) - the commands of the lines, and the exception raised by the first line
+            that could not be parsed (None if all of them were parsed). The commands of the lines before
+            that line are still returned.
+    """
+    commands = []
+    for line in lines:
+        try:
+            command = parse_log_line(line)
+        except Exception as e:
+            return commands, e
+
+        if command is not None:
+            commands.append(command)
+
+    return commands, None
+
+
+def replay_log_parallel(system, lines, jobs, out=None, stats=None):
+    """
+    Apply the commands of a Matamazon log to a system, parsing the lines in worker processes.
+
+    The log is split into chunks of parse_chunk_size lines, parsed by a pool of processes, and the
+    parsed commands are applied by the calling process in the original order of the lines, so the
+    result is the same as the result of replay_log.
+
+    Args:
+        system (MatamazonSystem): The system the commands are applied to.
+        lines: An iterable of log lines (str or bytes, e.g. an open log file or read_lines(path)).
+        jobs (int): Number of worker processes.
+        out (file-like, optional): Where search results are printed. Defaults to sys.stdout.
+        stats (Metrics, optional): If given, the commands are timed in it, per command (see log_handlers).
+
+    Returns:
+        int: The number of commands applied.
+
+    Raises:
+        Any exception raised while parsing or applying a line. The lines before it stay applied.
+    """
+    handlers = log_handlers(system, out, stats)
+    lines = iter(lines)
+    count = 0
+    with ProcessPoolExecutor(jobs) as pool:
+        pending = collections.deque()
+        try:
+            while True:
+                # keep a few chunks per worker in flight, without reading the whole log ahead
+                while len(pending) < 2 * jobs:
+                    chunk = list(itertools.islice(lines, parse_chunk_size))
+                    if not chunk:
+                        break
+                    pending.append(pool.submit(_parse_log_chunk, chunk))
+
+                if not pending:
+                    return count
+
+                commands, error = pending.popleft().result()
+                for name, args in commands:
+                    handlers[name](*args)
+                count += len(commands)
+
+                if error is not None:
+                    raise error
+        finally:
+            for future in pending:
+                future.cancel()
+
+
 # TODO all the main part here
 if __name__ == "__main__":
     i = 1
@@ -545,6 +4090,12 @@ if __name__ == "__main__":
     system_file = None
     output_file = None
     out_system_file = None
+    out_system_format = "text"
+    output_format = "json"
+    jobs = 1
+    stats_file = None
+    out_delta_file = None
+    lazy_load = False
 
     while i < argCount:
         arg = sys.argv[i]
@@ -582,82 +4133,110 @@ if __name__ == "__main__":
             else:
                 on_wrong_arg()
 
+        elif arg == "-of":
+            # format of the orders output: json (default) or ndjson (see export_orders_ndjson)
+            if next_arg_exists and sys.argv[i + 1] in ("json", "ndjson"):
+                output_format = sys.argv[i + 1]
+                i += 2
+
+            else:
+                on_wrong_arg()
+
+        elif arg == "-j":
+            # number of processes parsing the log (see replay_log_parallel)
+            if next_arg_exists and sys.argv[i + 1].isdigit() and int(sys.argv[i + 1]) > 0:
+                jobs = int(sys.argv[i + 1])
+                i += 2
+
+            else:
+                on_wrong_arg()
+
+        elif arg == "-osd":
+            # file the changes of the system file made by the log are written to (see export_system_delta)
+            if next_arg_exists:
+                out_delta_file = sys.argv[i + 1]
+                i += 2
+
+            else:
+                on_wrong_arg()
+
+        elif arg == "--stats":
+            # JSON file the call and command timings are written to at exit (see Metrics.report)
+            if next_arg_exists:
+                stats_file = sys.argv[i + 1]
+                i += 2
+
+            else:
+                on_wrong_arg()
+
+        elif arg == "--lazy":
+            # read the objects of the system file when the log first uses them (see load_system_lazily)
+            lazy_load = True
+            i += 1
+
+        elif arg == "-osf":
+            # format of the -os file: text (default) or binary (see export_system_snapshot)
+            if next_arg_exists and sys.argv[i + 1] in ("text", "binary"):
+                out_system_format = sys.argv[i + 1]
+                i += 2
+
+            else:
+                on_wrong_arg()
+
         else:
             on_wrong_arg()
 
     if log_file is None:
         on_wrong_arg()
 
+    metrics = None if stats_file is None else Metrics()
     try:
         system_file_exists = system_file and os.path.exists(system_file)
-        system = load_system_from_file(system_file) if system_file_exists else MatamazonSystem()
+        if not system_file_exists:
+            system = MatamazonSystem()
+        elif metrics is None:
+            system = load_system_from_file(system_file, lazy_load)
+        else:
+            load = metrics.wrap("load_system_from_file", load_system_from_file,
+                                lambda loaded: len(loaded.customers) + len(loaded.suppliers) + len(loaded.products))
+            system = load(system_file, lazy_load)
 
-        with open(log_file, 'r') as file:
-            for line in file:
-                sub_strings = line.strip().split()
-                if not sub_strings:
-                    continue
+        if metrics is not None:
+            system.enable_metrics(metrics)
+        if out_delta_file:
+            system.track_changes()
 
-                command = sub_strings[0]
-
-                if command == "register":
-                    entity_type = sub_strings[1]
-                    entity_id = int(sub_strings[2])
-                    name = swap_underscore(sub_strings[3])
-                    city = swap_underscore(sub_strings[4])
-                    address = swap_underscore(sub_strings[5])
-
-                    if entity_type == "customer":
-                        c = Customer(entity_id, name, city, address)
-                        system.register_entity(c, True)
-
-                    elif entity_type == "supplier":
-                        s = Supplier(entity_id, name, city, address)
-                        system.register_entity(s, False)
-
-                    else:
-                        raise Exception
-
-                elif command == "add" or command == "update":
-                    product_id = int(sub_strings[1])
-                    name = swap_underscore(sub_strings[2])
-                    price = float(sub_strings[3])
-                    supplier_id = int(sub_strings[4])
-                    quantity = int(sub_strings[5])
-
-                    product = Product(product_id, name, price, supplier_id, quantity)
-                    system.add_or_update_product(product)
-
-                elif command == "remove":
-                    class_type = sub_strings[1]
-                    order_id = int(sub_strings[2])
-                    system.remove_object(order_id, class_type)
-
-                elif command == "order":
-                    customer_id = int(sub_strings[1])
-                    product_id = int(sub_strings[2])
-                    quantity = default_order_quantity if len(sub_strings) <= 3 else int(sub_strings[3])
-                    system.place_order(customer_id, product_id, quantity)
-
-                elif command == "search":
-                    query = swap_underscore(sub_strings[1])
-                    max_price = default_query_max_price if len(sub_strings) <=2 else float(sub_strings[2])
-                    results = system.search_products(query, max_price)
-                    print(results)
+        if jobs > 1:
+            replay_log_parallel(system, read_lines(log_file), jobs, stats=metrics)
+        else:
+            replay_log(system, read_lines(log_file), stats=metrics)
 
-                else:
-                    raise Exception
+        export_orders = system.export_orders_ndjson if output_format == "ndjson" else system.export_orders
         if output_file:
             with open(output_file, 'w') as file:
-                system.export_orders(file)
+                export_orders(file)
         else:
-            system.export_orders(sys.stdout)
+            export_orders(sys.stdout)
+
+        if out_delta_file:
+            system.export_system_delta(out_delta_file)
 
         if out_system_file:
-            system.export_system_to_file(out_system_file)
+            if out_system_format == "binary":
+                system.export_system_snapshot(out_system_file)
+            else:
+                system.export_system_to_file(out_system_file)
 
     except Exception as e:
         print("The matamazon script has encountered an error")
         exit(0)
 
+    finally:
+        if metrics is not None:
+            try:
+                with open(stats_file, 'w') as file:
+                    json.dump(metrics.report(), file, indent=2)
+            except OSError:
+                print("The matamazon script has encountered an error")
+
 
@@ -0,0 +1,20 @@
+from matamazon import Customer, Supplier, Product, Journal
+
+
+def test_recover_transaction_committed_across_checkpoint(tmp_path):
+    journal = Journal(str(tmp_path), checkpoint_records=3)
+    system = journal.recover()
+    with system.transaction():
+        system.register_entity(Customer(1, "Customer", "Haifa", "Herzl"), True)
+        system.register_entity(Supplier(2, "Supplier", "Haifa", "Herzl"), False)
+        system.add_or_update_product(Product(10, "product", 1.5, 2, 10))
+        system.place_order(1, 10)
+        system.place_order(1, 10)
+    journal.close()
+
+    journal = Journal(str(tmp_path))
+    recovered = journal.recover()
+    journal.close()
+    assert sorted(recovered.orders) == [1, 2]
+    assert recovered.products[10].quantity == 8
+    assert recovered.next_id == system.next_id